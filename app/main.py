@@ -1,13 +1,24 @@
 import os
-from fastapi import FastAPI, File, UploadFile, Request
+import re
+import json
+import time
+import shutil
+import logging
+import openai
+from fastapi import FastAPI, File, Form, Header, UploadFile, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, RedirectResponse
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 from dotenv import load_dotenv
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
+from utils.scheduler import scheduler, INTERACTIVE
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 app = FastAPI()
 
 # Mount static files for Bootstrap and JS
@@ -17,46 +28,323 @@ templates = Jinja2Templates(directory="app/templates")
 
 GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT", None)
 BUCKET_NAME = os.getenv("BUCKET_NAME", None)
+BUCKET_TRANSCRIPTS = os.getenv("BUCKET_TRANSCRIPTS", None)
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", None)
 
 assert GOOGLE_CLOUD_PROJECT, "GOOGLE_CLOUD_PROJECT environment variable is not set"
 assert BUCKET_NAME, "BUCKET_NAME environment variable is not set"
+assert BUCKET_TRANSCRIPTS, "BUCKET_TRANSCRIPTS environment variable is not set"
+assert OPENAI_API_KEY, "OPENAI_API_KEY environment variable is not set"
+
+# retries are handled by the scheduler
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
+# characters of the running transcript passed to whisper as context of the next segment
+PROMPT_CHARS = 500
+SESSION_ID_PATTERN = re.compile(r"^[\w-]{1,64}$")
+# finished recordings are archived here, functions/transcript skips this folder (RECORDINGS_FOLDER)
+RECORDINGS_FOLDER = "recordings/"
+# segments of live recordings are kept in BUCKET_NAME under <SESSIONS_FOLDER><session id>/, so any
+# instance of the app can take the next segment. Finished sessions are deleted, a lifecycle rule on
+# this prefix removes unfinished ones
+SESSIONS_FOLDER = f"{RECORDINGS_FOLDER}sessions/"
+SESSION_INFO = "session.json"
+# running transcript of the session, context of the next segment
+SESSION_TRANSCRIPT = "transcript.txt"
+# 10 s segments of the recorder are ~160 kB
+MAX_SEGMENT_BYTES = int(os.getenv("MAX_SEGMENT_BYTES", 5 * 1024 * 1024))
+# GCS composes at most 32 objects in one request
+COMPOSE_LIMIT = 32
+# tenant of uploads without X-Tenant-ID header or tenant_id form field. Both are trusted input,
+# the app does not authenticate tenants, deploy it behind a proxy that sets X-Tenant-ID itself
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "")
+TENANT_ID_PATTERN = re.compile(r"^[\w-]{1,64}$")
+# uploads with X-Analysis header or analysis form field "deferred" are analyzed by a batch job
+# (functions/analyze/batch.py) instead of on_new_transcript, keep in sync with DEFERRED there
+DEFERRED = "deferred"
 
-def upload_to_gcs(file_path, file_name, folder: str) -> str:
+
+def upload_to_gcs(file_path, file_name, folder: str, tenant_id: str = "", analysis: str = "") -> str:
     """Uploads a file to Google Cloud Storage."""
     client = storage.Client()
     bucket = client.bucket(BUCKET_NAME)
     blob = bucket.blob(os.path.join(folder, file_name))
+    blob.metadata = pipeline_metadata(tenant_id, analysis)
     blob.upload_from_filename(file_path)
     return f"https://storage.googleapis.com/{BUCKET_NAME}/{folder}{file_name}"
 
 
+def upload_bytes_to_gcs(
+    data: bytes | str,
+    file_name: str,
+    folder: str = "",
+    bucket_name: str = BUCKET_NAME,
+    tenant_id: str = "",
+    analysis: str = "",
+) -> str:
+    """Uploads in-memory data to Google Cloud Storage."""
+    client = storage.Client()
+    bucket = client.bucket(bucket_name)
+    blob = bucket.blob(os.path.join(folder, file_name))
+    blob.metadata = pipeline_metadata(tenant_id, analysis)
+    blob.upload_from_string(data)
+    return f"https://storage.googleapis.com/{bucket_name}/{folder}{file_name}"
+
+
+def save_upload(file: UploadFile, folder: str, tenant_id: str = "", analysis: str = "") -> str:
+    """Saves the uploaded file locally and uploads it to Google Cloud Storage, blocking."""
+    file_location = f"app/static/{file.filename}"
+    with open(file_location, "wb") as f:
+        shutil.copyfileobj(file.file, f)
+    try:
+        return upload_to_gcs(file_location, file.filename, folder, tenant_id, analysis)
+    finally:
+        os.remove(file_location)  # Cleanup local file after upload
+
+
+def get_tenant(header: str | None, form: str | None) -> str:
+    tenant_id = header or form or DEFAULT_TENANT
+    if tenant_id and not TENANT_ID_PATTERN.match(tenant_id):
+        raise HTTPException(status_code=400, detail="Invalid tenant id")
+    return tenant_id
+
+
+def get_analysis(header: str | None, form: str | None) -> str:
+    analysis = header or form or ""
+    if analysis not in ("", DEFERRED):
+        raise HTTPException(status_code=400, detail=f"Invalid analysis mode, use {DEFERRED}")
+    return analysis
+
+
+def pipeline_metadata(tenant_id: str, analysis: str = "") -> dict | None:
+    # object metadata is carried through every pipeline stage, tenant_id into the point payload
+    metadata = {key: value for key, value in (("tenant_id", tenant_id), ("analysis", analysis)) if value}
+    return metadata or None
+
+
+def session_prefix(session_id: str) -> str:
+    return f"{SESSIONS_FOLDER}{session_id}/"
+
+
+def session_blob(session_id: str, name: str) -> storage.Blob:
+    return storage.Client().bucket(BUCKET_NAME).blob(f"{session_prefix(session_id)}{name}")
+
+
+def segment_name(index: int, extension: str) -> str:
+    return f"segment_{index:05d}.{extension}"
+
+
+def check_session_id(session_id: str):
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session id")
+
+
+def load_session(session_id: str) -> dict:
+    try:
+        return json.loads(session_blob(session_id, SESSION_INFO).download_as_text())
+    except NotFound:
+        raise HTTPException(status_code=404, detail="Recording not found")
+
+
+def read_session_text(session_id: str, name: str) -> str:
+    try:
+        return session_blob(session_id, name).download_as_text()
+    except NotFound:
+        return ""
+
+
+def store_segment(session_id: str, index: int, audio: bytes, tenant_id: str) -> dict:
+    """Saves the audio of a segment, segments are accepted once and in order. Returns the session."""
+    if index == 0:
+        # the first segment decides the tenant of the whole recording
+        session = {"tenant_id": tenant_id, "created": time.time()}
+        try:
+            session_blob(session_id, SESSION_INFO).upload_from_string(json.dumps(session), if_generation_match=0)
+        except PreconditionFailed:
+            session = load_session(session_id)
+    else:
+        if not session_blob(session_id, segment_name(index - 1, "mp3")).exists():
+            raise HTTPException(status_code=409, detail=f"Segment {index - 1} was not uploaded yet")
+        session = load_session(session_id)
+
+    try:
+        # only created if it does not exist, also across instances
+        session_blob(session_id, segment_name(index, "mp3")).upload_from_string(
+            audio, content_type="audio/mpeg", if_generation_match=0
+        )
+    except PreconditionFailed:
+        raise HTTPException(status_code=409, detail=f"Segment {index} already uploaded")
+    return session
+
+
+def save_segment_transcript(session_id: str, index: int, text: str, transcript: str):
+    # the segment transcript marks the segment as transcribed for finish_recording
+    session_blob(session_id, segment_name(index, "txt")).upload_from_string(text)
+    session_blob(session_id, SESSION_TRANSCRIPT).upload_from_string(transcript)
+
+
+def count_segments(session_id: str) -> tuple[int, int]:
+    """Uploaded and transcribed segments of the session"""
+    blobs = storage.Client().list_blobs(BUCKET_NAME, prefix=f"{session_prefix(session_id)}segment_")
+    names = [blob.name for blob in blobs]
+    return sum(name.endswith(".mp3") for name in names), sum(name.endswith(".txt") for name in names)
+
+
+def assemble_recording(session_id: str, tenant_id: str) -> tuple[str, str | None]:
+    """Joins the segments into one recording, returns its URL and the transcript (None if incomplete)"""
+    client = storage.Client()
+    bucket = client.bucket(BUCKET_NAME)
+    blobs = list(client.list_blobs(BUCKET_NAME, prefix=f"{session_prefix(session_id)}segment_"))
+    audio = sorted((blob for blob in blobs if blob.name.endswith(".mp3")), key=lambda blob: blob.name)
+    transcribed = sum(blob.name.endswith(".txt") for blob in blobs)
+    if not audio:
+        raise HTTPException(status_code=409, detail="Recording has no segments")
+
+    # MP3 frames of consecutive segments concatenate into a single valid file, composed in GCS
+    # in steps of COMPOSE_LIMIT objects (the partial result being one of them)
+    recording = session_blob(session_id, "recording.mp3")
+    recording.content_type = "audio/mpeg"
+    recording.metadata = pipeline_metadata(tenant_id)
+    for first in range(0, len(audio), COMPOSE_LIMIT - 1):
+        recording.compose(([recording] if first else []) + audio[first : first + COMPOSE_LIMIT - 1])
+
+    file_name = f"recording_{session_id}.mp3"
+    transcript = None
+    if transcribed == len(audio):
+        transcript = read_session_text(session_id, SESSION_TRANSCRIPT).strip()
+        # same name as transcripts of the audio pipeline so the analysis stage picks it up
+        upload_bytes_to_gcs(transcript, f"{file_name}.txt", "", BUCKET_TRANSCRIPTS, tenant_id)
+        folder = RECORDINGS_FOLDER
+    else:
+        # let the audio pipeline transcribe the whole recording instead
+        log.error(f"Recording {session_id}: {len(audio) - transcribed} of {len(audio)} segments not transcribed")
+        folder = "audio/"
+    # a single copy fires the storage trigger of the audio pipeline once
+    bucket.copy_blob(recording, bucket, f"{folder}{file_name}")
+
+    for blob in client.list_blobs(BUCKET_NAME, prefix=session_prefix(session_id)):
+        blob.delete()
+    return f"https://storage.googleapis.com/{BUCKET_NAME}/{folder}{file_name}", transcript
+
+
+async def transcribe_segment(session_id: str, index: int, audio: bytes) -> str:
+    """Transcribes the segment in the context of the previous ones, returns the running transcript"""
+    previous = await run_in_threadpool(read_session_text, session_id, SESSION_TRANSCRIPT)
+    transcription = await scheduler.acall(
+        openai_client.audio.transcriptions.create,
+        priority=INTERACTIVE,
+        model="whisper-1",
+        file=(f"{session_id}_{index}.mp3", audio),
+        prompt=previous[-PROMPT_CHARS:],
+    )
+    text = transcription.text.strip()
+    transcript = f"{previous} {text}".strip()
+    await run_in_threadpool(save_segment_transcript, session_id, index, text, transcript)
+    log.info(f"Recording {session_id} segment {index}: {text[:100]}")
+    return transcript
+
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
 @app.post("/upload/audio")
-async def upload_audio(file: UploadFile = File(...)):
+async def upload_audio(
+    file: UploadFile = File(...),
+    tenant_id: str | None = Form(None),
+    x_tenant_id: str | None = Header(None),
+    analysis: str | None = Form(None),
+    x_analysis: str | None = Header(None),
+):
     """Handles audio file upload and saves to Google Cloud Storage."""
-    file_location = f"app/static/{file.filename}"
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
+    tenant_id = get_tenant(x_tenant_id, tenant_id)
+    analysis = get_analysis(x_analysis, analysis)
+    # file IO and upload off the event loop
+    gcs_url = await run_in_threadpool(save_upload, file, "audio/", tenant_id, analysis)
+
+    return {"message": "File uploaded successfully", "url": gcs_url}
 
-    gcs_url = upload_to_gcs(file_location, file.filename, "audio/")
-    os.remove(file_location)  # Cleanup local file after upload
 
+@app.post("/upload/record")
+async def upload_record(
+    file: UploadFile = File(...),
+    tenant_id: str | None = Form(None),
+    x_tenant_id: str | None = Header(None),
+    analysis: str | None = Form(None),
+    x_analysis: str | None = Header(None),
+):
+    """Handles a whole recording upload, transcribed by the audio pipeline."""
+    tenant_id = get_tenant(x_tenant_id, tenant_id)
+    analysis = get_analysis(x_analysis, analysis)
+    gcs_url = await run_in_threadpool(
+        upload_bytes_to_gcs, await file.read(), file.filename, "audio/", tenant_id=tenant_id, analysis=analysis
+    )
     return {"message": "File uploaded successfully", "url": gcs_url}
 
 
+@app.post("/record/{session_id}/segment/{index}")
+async def upload_segment(
+    session_id: str,
+    index: int,
+    file: UploadFile = File(...),
+    tenant_id: str | None = Form(None),
+    x_tenant_id: str | None = Header(None),
+):
+    """Receives a segment of a live recording and transcribes it."""
+    check_session_id(session_id)
+    if index < 0:
+        raise HTTPException(status_code=400, detail="Invalid segment index")
+    tenant_id = get_tenant(x_tenant_id, tenant_id)
+
+    audio = await file.read(MAX_SEGMENT_BYTES + 1)
+    if len(audio) > MAX_SEGMENT_BYTES:
+        raise HTTPException(status_code=413, detail=f"Segment is larger than {MAX_SEGMENT_BYTES} bytes")
+
+    await run_in_threadpool(store_segment, session_id, index, audio, tenant_id)
+    try:
+        transcript = await transcribe_segment(session_id, index, audio)
+    except Exception as e:
+        # the segment is kept, finish_recording hands the recording to the audio pipeline
+        log.error(f"Recording {session_id}: transcription of segment {index} failed: {e}")
+        transcript = await run_in_threadpool(read_session_text, session_id, SESSION_TRANSCRIPT)
+
+    return {"segment": index, "transcript": transcript}
+
+
+@app.get("/record/{session_id}")
+async def recording_transcript(session_id: str):
+    """Returns the running transcript of a live recording."""
+    check_session_id(session_id)
+    await run_in_threadpool(load_session, session_id)
+    segments, _ = await run_in_threadpool(count_segments, session_id)
+    transcript = await run_in_threadpool(read_session_text, session_id, SESSION_TRANSCRIPT)
+    return {"segments": segments, "transcript": transcript}
+
+
+@app.post("/record/{session_id}/finish")
+async def finish_recording(session_id: str):
+    """Assembles the segments and saves the transcript for analysis."""
+    check_session_id(session_id)
+    session = await run_in_threadpool(load_session, session_id)
+    gcs_url, transcript = await run_in_threadpool(assemble_recording, session_id, session["tenant_id"])
+
+    if transcript is None:
+        return {"message": "Recording uploaded, transcription continues in background", "url": gcs_url}
+    return {"message": "Transcription complete!", "url": gcs_url, "transcript": transcript}
+
+
 @app.post("/upload/document")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(
+    file: UploadFile = File(...),
+    tenant_id: str | None = Form(None),
+    x_tenant_id: str | None = Header(None),
+    analysis: str | None = Form(None),
+    x_analysis: str | None = Header(None),
+):
     """Handles document file upload and saves to Google Cloud Storage."""
-    file_location = f"app/static/{file.filename}"
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
-
-    gcs_url = upload_to_gcs(file_location, file.filename, "documents/")
-    os.remove(file_location)
+    tenant_id = get_tenant(x_tenant_id, tenant_id)
+    analysis = get_analysis(x_analysis, analysis)
+    await run_in_threadpool(save_upload, file, "documents/", tenant_id, analysis)
 
     return RedirectResponse(url="/", status_code=303)
@@ -1,12 +1,21 @@
 let recordButton = document.getElementById("recordButton");
 let statusText = document.getElementById("status");
+let transcriptText = document.getElementById("transcript");
 
 // Initialize MicRecorderToMp3 with settings
 const Mp3Recorder = new MicRecorder({
     bitRate: 128 // 128 kbps for good quality-to-size balance
 });
 
+// Recording is uploaded in segments of this length and transcribed while recording
+const SEGMENT_SECONDS = 10;
+
 let isRecording = false;
+let sessionId = null;
+let segmentIndex = 0;
+let segmentTimer = null;
+// segments are uploaded one after another so the server receives them in order
+let uploadChain = Promise.resolve();
 
 
 var wavesurfer = WaveSurfer.create({
@@ -19,6 +28,52 @@ var wavesurfer = WaveSurfer.create({
     ]
 });
 
+function uploadSegment(blob) {
+    const index = segmentIndex++;
+    let formData = new FormData();
+    formData.append("file", blob, `segment_${index}.mp3`);
+
+    uploadChain = uploadChain
+        .then(() => fetch(`/record/${sessionId}/segment/${index}`, { method: "POST", body: formData }))
+        .then(response => response.json())
+        .then(result => {
+            if (result.transcript) {
+                transcriptText.innerText = result.transcript;
+            }
+        })
+        .catch(error => {
+            console.error(`Segment ${index} upload error:`, error);
+        });
+}
+
+// Take MP3 frames encoded since the last cut, the encoder keeps running so there is no gap
+function cutSegment() {
+    const encoder = Mp3Recorder.lameEncoder;
+    if (!encoder || encoder.dataBuffer.length === 0) {
+        return;
+    }
+    const blob = new Blob(encoder.dataBuffer, { type: 'audio/mp3' });
+    encoder.clearBuffer();
+    uploadSegment(blob);
+}
+
+function finishRecording() {
+    statusText.innerText = "Finishing transcript...";
+    uploadChain
+        .then(() => fetch(`/record/${sessionId}/finish`, { method: "POST" }))
+        .then(response => response.json())
+        .then(result => {
+            if (result.transcript) {
+                transcriptText.innerText = result.transcript;
+            }
+            statusText.innerText = result.message || "Upload failed!";
+        })
+        .catch(error => {
+            console.error("Finish error:", error);
+            statusText.innerText = "Upload failed!";
+        });
+}
+
 // Handle record button click
 recordButton.addEventListener("click", function () {
     if (!isRecording) {
@@ -29,6 +84,10 @@ recordButton.addEventListener("click", function () {
         Mp3Recorder.start()
             .then(() => {
                 isRecording = true;
+                sessionId = crypto.randomUUID();
+                segmentIndex = 0;
+                transcriptText.innerText = "";
+                segmentTimer = setInterval(cutSegment, SEGMENT_SECONDS * 1000);
                 recordButton.innerText = "Stop";
                 statusText.innerText = "Recording...";
             })
@@ -37,40 +96,23 @@ recordButton.addEventListener("click", function () {
                 statusText.innerText = "Microphone access denied.";
             });
     } else {
-        // Stop recording
+        clearInterval(segmentTimer);
+
+        // Stop recording, the last segment contains the rest of the encoded audio
         Mp3Recorder.stop().getMp3()
             .then(([buffer, blob]) => {
+                uploadSegment(blob);
+            })
+            .catch(error => {
+                // nothing recorded since the last cut
+                console.warn("Last segment:", error);
+            })
+            .finally(() => {
                 // Stop microphone visualization
                 wavesurfer.microphone.stop();
 
-                //generate random filename
-                const random = Math.floor(Math.random() * 1000000);
-                const filename = `recording_${random}.mp3`;
-                // Upload the audio
-                let formData = new FormData();
-                formData.append("file", blob, filename);
+                finishRecording();
 
-                statusText.innerText = "Uploading...";
-                fetch("/upload/record", { method: "POST", body: formData })
-                    .then(response => response.json())
-                    .then(result => {
-                        if (result.url) {
-                            statusText.innerHTML = `Upload complete! <a href="${result.url}" target="_blank">Listen here</a>`;
-                        } else {
-                            statusText.innerText = "Upload failed!";
-                        }
-                    })
-                    .catch(error => {
-                        console.error("Upload error:", error);
-                        statusText.innerText = "Upload failed!";
-                    });
-
-                isRecording = false;
-                recordButton.innerText = "Record";
-            })
-            .catch(error => {
-                console.error("Recording error:", error);
-                statusText.innerText = "Recording failed!";
                 isRecording = false;
                 recordButton.innerText = "Record";
             });
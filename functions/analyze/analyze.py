@@ -4,9 +4,14 @@ import openai
 from google.cloud import storage, secretmanager
 import dotenv
 import os
+import re
+import tiktoken
 from datetime import datetime
 from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
 import json
+from scheduler import scheduler, estimate_tokens, BULK
+import deadletter
 
 dotenv.load_dotenv()
 
@@ -30,11 +35,18 @@ if not OPENAI_API_KEY:
 assert OPENAI_API_KEY, "OPENAI_API_KEY environment variable is not set"
 
 
-MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", 4096))
-OVERLAP = int(os.getenv("OVERLAP", 1024))
+# chunk size and overlap are measured in model tokens
+MAX_CHUNK_TOKENS = int(os.getenv("MAX_CHUNK_TOKENS", 1024))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 128))
 VECTOR_SIZE = int(os.getenv("VECTOR_SIZE"))
 assert VECTOR_SIZE, "VECTOR_SIZE environment variable is not set"
 
+# number of chunks analyzed in one structured-output request and parallel requests
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", 4))
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", 4))
+# answer the generated phrases from their chunk, stored in the FAQ index by on_knowledge
+FAQ_ANSWERS = os.getenv("FAQ_ANSWERS", "0") == "1"
+
 BUCKET_KNOWLEDGE = os.getenv("BUCKET_KNOWLEDGE")
 BUCKET_PROCESSED = os.getenv("BUCKET_PROCESSED")
 assert BUCKET_KNOWLEDGE, "BUCKET_KNOWLEDGE environment variable is not set"
@@ -49,73 +61,346 @@ searchable and retrievable by the user. The knowledge base should contain
 all relevant information, analysis, and embeddings for the uploaded content.
 Phrases should contain frequently asked question regarding this chunk of information.
 Keypoints should contain extracted, factual data from the text. Numbers, dates, names, laws, paragraphs, etc.
+Language should contain ISO 639-1 code of the analyzed text language (e.g. "sk", "en").
 Respond in analyzed texts original language.
 Current date and time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 """
 
+FAQ_ANSWER_PROMPT = """
+Answer each question using only the provided text, in the language of the question.
+Answers must be complete and self-contained, 1-3 sentences.
+If the text does not answer a question, return an empty answer for it.
+"""
+
+BATCH_ANALYZER_PROMPT = """
+The input contains several chunks of one text, each wrapped in <chunk index="N"> tags.
+Analyze every chunk separately and return exactly one analysis per chunk, in the order of the chunks.
+"""
+
 # Initialize OpenAI client
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# retries are handled by the scheduler
+openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 
 # Initialize Google Cloud Storage client
 storage_client = storage.Client()
 
+encoding = tiktoken.get_encoding("o200k_base")  # gpt-4o family
+
+# sentences including trailing whitespace, a blank line also ends a sentence
+SENTENCE_PATTERN = re.compile(r".+?(?:[.!?…]+(?=\s)|\n\s*\n|$)\s*", re.DOTALL)
+# start of a legal section, e.g. "§ 5", "Paragraf 2.", "Článok 3"
+SECTION_PATTERN = re.compile(r"\s*(?:§+\s*\d|(?:paragra(?:f|ph)\w*|článok|čl\.|section|article)\s+\d)", re.IGNORECASE)
+
+# boundary strength of a sentence start
+SENTENCE = 0
+PARAGRAPH = 1
+SECTION = 2
+
+# name of this pipeline stage in dead-letter records
+STAGE = "analyze"
+# transcripts with this "analysis" metadata are left for a batch job, see batch.py
+DEFERRED = "deferred"
+
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+DOCUMENT_EXTENSIONS = (".pdf",)
+
 
 class AnalysisModel(BaseModel):
     phrases: list[str]
     keypoints: list[str]
+    language: str
+
+
+class FaqAnswerModel(BaseModel):
+    question: str
+    answer: str
+
+
+class FaqAnswersModel(BaseModel):
+    answers: list[FaqAnswerModel]
+
+
+class FaqModel(BaseModel):
+    question: str
+    answer: str
+    embeddings: list[float]
 
 
 class KnowledgeModel(BaseModel):
     information: str
     analysis: AnalysisModel
     embeddings: list[float]
+    source: str = ""
+    media_type: str = "text"
+    chunk_index: int = 0
+    tenant_id: str = ""
+    faq: list[FaqModel] = []
+
+
+class BatchAnalysisModel(BaseModel):
+    analyses: list[AnalysisModel]
+
+
+def strict_schema(model: type[BaseModel]) -> dict:
+    """JSON schema of the model usable with strict structured outputs"""
+    schema = model.model_json_schema()
+    for definition in [schema, *schema.get("$defs", {}).values()]:
+        definition["additionalProperties"] = False
+    return schema
+
+
+ANALYSIS_SCHEMA = strict_schema(AnalysisModel)
+BATCH_ANALYSIS_SCHEMA = strict_schema(BatchAnalysisModel)
+FAQ_ANSWERS_SCHEMA = strict_schema(FaqAnswersModel)
+
+
+def media_type_from_name(source: str) -> str:
+    """Guess the media type of the original upload from its file name"""
+    if source.endswith(AUDIO_EXTENSIONS):
+        return "audio"
+    if source.endswith(DOCUMENT_EXTENSIONS):
+        return "document"
+    return "text"
+
+
+def count_tokens(text: str) -> int:
+    return len(encoding.encode(text))
+
+
+def split_sentences(text: str) -> list[tuple[str, int, int]]:
+    """Split text into (sentence, tokens, boundary) in one pass"""
+    sentences = []
+    boundary = SECTION
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group(0)
+        if SECTION_PATTERN.match(sentence):
+            boundary = SECTION
+        sentences.append((sentence, count_tokens(sentence), boundary))
+        # blank line after the sentence starts a new paragraph
+        boundary = PARAGRAPH if sentence.count("\n") > 1 else SENTENCE
+    return sentences
+
+
+def split_long_sentence(sentence: str) -> list[tuple[str, int]]:
+    """Split a sentence longer than MAX_CHUNK_TOKENS on words"""
+    parts = []
+    part, part_tokens = "", 0
+    for word in re.findall(r"\S+\s*", sentence):
+        tokens = count_tokens(word)
+        if part and part_tokens + tokens > MAX_CHUNK_TOKENS:
+            parts.append((part, part_tokens))
+            part, part_tokens = "", 0
+        part += word
+        part_tokens += tokens
+    if part:
+        parts.append((part, part_tokens))
+    return parts
+
+
+def overlap_tail(sentences: list[tuple[str, int]], budget: int) -> list[tuple[str, int]]:
+    """Trailing whole sentences fitting into the overlap budget"""
+    tail, tokens = [], 0
+    for sentence, sentence_tokens in reversed(sentences):
+        if tokens + sentence_tokens > budget:
+            break
+        tail.insert(0, (sentence, sentence_tokens))
+        tokens += sentence_tokens
+    return tail
 
 
 def chunk_text(text: str) -> list[str]:
-    if len(text) < MAX_TEXT_LENGTH:
-        return [text]
+    """Pack sentences into chunks of at most MAX_CHUNK_TOKENS.
+
+    Chunks preferably end at section and paragraph boundaries. The overlap adapts to the
+    boundary: none before a new section, half before a paragraph, CHUNK_OVERLAP_TOKENS
+    of trailing sentences otherwise.
+    """
+    chunks = []
+    current: list[tuple[str, int]] = []
+    current_tokens = 0
+    fresh = 0  # sentences of the current chunk not repeated from the previous one
+
+    def flush(overlap_budget: int):
+        nonlocal current, current_tokens, fresh
+        if fresh:
+            chunks.append("".join(sentence for sentence, _ in current).strip())
+        current = overlap_tail(current, overlap_budget) if overlap_budget else []
+        current_tokens = sum(tokens for _, tokens in current)
+        fresh = 0
+
+    for sentence, tokens, boundary in split_sentences(text):
+        if tokens > MAX_CHUNK_TOKENS:
+            flush(0)
+            chunks.extend(part.strip() for part, _ in split_long_sentence(sentence))
+            continue
+
+        if fresh and boundary == SECTION and current_tokens >= MAX_CHUNK_TOKENS // 2:
+            flush(0)
+        elif fresh and boundary == PARAGRAPH and current_tokens >= MAX_CHUNK_TOKENS * 3 // 4:
+            flush(CHUNK_OVERLAP_TOKENS // 2)
+        elif current_tokens + tokens > MAX_CHUNK_TOKENS:
+            flush(min(CHUNK_OVERLAP_TOKENS, MAX_CHUNK_TOKENS - tokens))
+
+        current.append((sentence, tokens))
+        current_tokens += tokens
+        fresh += 1
+
+    flush(0)
+    # empty or whitespace-only transcripts (silent recordings) have no chunks
+    return [chunk for chunk in chunks if chunk] or ([text.strip()] if text.strip() else [])
+
+
+def analysis_request(chunks: list[str]) -> dict:
+    """Responses API arguments analyzing one chunk, or several chunks in one structured output"""
+    if len(chunks) == 1:
+        instructions, text = ANALYZER_SYSTEM_PROMPT, chunks[0]
+        name, schema = "probable_questions", ANALYSIS_SCHEMA
     else:
-        return [text[i : i + MAX_TEXT_LENGTH + OVERLAP] for i in range(0, len(text), MAX_TEXT_LENGTH)]
+        instructions = ANALYZER_SYSTEM_PROMPT + BATCH_ANALYZER_PROMPT
+        text = "\n\n".join(f'<chunk index="{i}">\n{chunk}\n</chunk>' for i, chunk in enumerate(chunks))
+        name, schema = "chunk_analyses", BATCH_ANALYSIS_SCHEMA
+
+    return {
+        "model": "gpt-4o-mini",
+        "instructions": instructions,
+        "input": text,
+        "text": {
+            "format": {
+                "type": "json_schema",
+                "name": name,
+                "schema": schema,
+                "strict": True,
+            }
+        },
+    }
+
+
+def parse_analysis(output_text: str, chunks: int) -> list[AnalysisModel]:
+    if chunks == 1:
+        return [AnalysisModel(**json.loads(output_text))]
+    return BatchAnalysisModel(**json.loads(output_text)).analyses
 
 
 def analyze_with_gpt(transcription: str) -> AnalysisModel:
     assert transcription, "Transcription cannot be empty"
     assert isinstance(transcription, str), "Transcription must be a string"
 
-    schema = AnalysisModel.model_json_schema()
-    schema["additionalProperties"] = False
+    response = scheduler.call(
+        openai_client.responses.create,
+        priority=BULK,
+        estimated_tokens=estimate_tokens(transcription),
+        **analysis_request([transcription]),
+    )
+    return parse_analysis(response.output_text, 1)[0]
+
+
+def analyze_batch_with_gpt(chunks: list[str]) -> list[AnalysisModel]:
+    """Analyze several chunks in one structured-output request"""
+    if len(chunks) == 1:
+        return [analyze_with_gpt(chunks[0])]
+
+    request = analysis_request(chunks)
+    response = scheduler.call(
+        openai_client.responses.create,
+        priority=BULK,
+        estimated_tokens=estimate_tokens(request["input"]),
+        **request,
+    )
+    analyses = parse_analysis(response.output_text, len(chunks))
+
+    if len(analyses) != len(chunks):
+        log.warning(f"Batch analysis returned {len(analyses)} results for {len(chunks)} chunks, retrying per chunk")
+        return [analyze_with_gpt(chunk) for chunk in chunks]
+
+    return analyses
+
+
+def analyze_chunks(chunks: list[str]) -> list[AnalysisModel]:
+    batches = [chunks[i : i + ANALYSIS_BATCH_SIZE] for i in range(0, len(chunks), ANALYSIS_BATCH_SIZE)]
+    log.info(f"Analyzing {len(chunks)} chunks in {len(batches)} batches")
 
-    response = openai_client.responses.create(
+    with ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY) as executor:
+        results = executor.map(analyze_batch_with_gpt, batches)
+
+    return [analysis for batch in results for analysis in batch]
+
+
+def create_embedding(text: str) -> dict:
+    return create_embeddings([text])[0]
+
+
+def embedding_request(texts: list[str]) -> dict:
+    return {"model": "text-embedding-3-small", "input": texts, "dimensions": VECTOR_SIZE}
+
+
+def create_embeddings(texts: list[str]) -> list[list[float]]:
+    response = scheduler.call(
+        openai_client.embeddings.create,
+        priority=BULK,
+        estimated_tokens=estimate_tokens(*texts),
+        **embedding_request(texts),
+    )
+
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def answer_phrases(chunk: str, phrases: list[str]) -> list[FaqAnswerModel]:
+    """Answers of the phrases found in the chunk itself"""
+    if not phrases:
+        return []
+
+    questions = "\n".join(f"- {phrase}" for phrase in phrases)
+    response = scheduler.call(
+        openai_client.responses.create,
+        priority=BULK,
+        estimated_tokens=estimate_tokens(chunk, questions),
         model="gpt-4o-mini",
-        instructions=ANALYZER_SYSTEM_PROMPT,
-        input=transcription,
+        instructions=FAQ_ANSWER_PROMPT,
+        input=[
+            {"role": "developer", "content": chunk},
+            {"role": "user", "content": questions},
+        ],
         text={
             "format": {
                 "type": "json_schema",
-                "name": "probable_questions",
-                "schema": schema,
+                "name": "faq_answers",
+                "schema": FAQ_ANSWERS_SCHEMA,
                 "strict": True,
             }
         },
     )
-    structured_response = json.loads(response.output_text)
-    return AnalysisModel(**structured_response)
+    answers = FaqAnswersModel(**json.loads(response.output_text)).answers
+    return [answer for answer in answers if answer.question.strip() and answer.answer.strip()]
 
 
-def create_embedding(text: str) -> dict:
-    response = openai_client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text,
-        dimensions=VECTOR_SIZE,
-    )
+def create_faq(chunks: list[str], analyses: list[AnalysisModel]) -> list[list[FaqModel]]:
+    """Answered phrases of every chunk with embeddings of the questions"""
+    with ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY) as executor:
+        answers = list(executor.map(answer_phrases, chunks, [analysis.phrases for analysis in analyses]))
+
+    questions = [answer.question for chunk_answers in answers for answer in chunk_answers]
+    log.info(f"Answered {len(questions)} phrases of {len(chunks)} chunks")
+    # questions are embedded like search queries, so a query vector can be matched against them
+    embeddings = iter(create_embeddings(questions) if questions else [])
+
+    return [
+        [
+            FaqModel(question=answer.question, answer=answer.answer, embeddings=next(embeddings))
+            for answer in chunk_answers
+        ]
+        for chunk_answers in answers
+    ]
 
-    return response.data[0].embedding
 
+def analysis_to_text(analysis: AnalysisModel) -> str:
+    return "\n".join(analysis.phrases) + "\n".join(analysis.keypoints)
 
-def create_knowledge(information: str) -> KnowledgeModel:
+
+def create_knowledge(information: str, source: str = "", chunk_index: int = 0) -> KnowledgeModel:
     analysis = analyze_with_gpt(information)
-    analysis_text = "\n".join(analysis.phrases) + "\n".join(analysis.keypoints)
+    analysis_text = analysis_to_text(analysis)
 
     embedding = create_embedding(analysis_text)
 
@@ -123,11 +408,45 @@ def create_knowledge(information: str) -> KnowledgeModel:
         information=information,
         analysis=analysis,
         embeddings=embedding,
+        source=source,
+        media_type=media_type_from_name(source),
+        chunk_index=chunk_index,
     )
 
     return knowledge
 
 
+def create_knowledge_chunks(text: str, source: str = "", tenant_id: str = "") -> list[KnowledgeModel]:
+    """Chunk the text and analyze and embed all chunks in batches"""
+    chunks = chunk_text(text)
+    if not chunks:
+        log.info(f"Nothing to analyze in {source or 'text'}, it is empty")
+        return []
+    analyses = analyze_chunks(chunks)
+    embeddings = create_embeddings([analysis_to_text(analysis) for analysis in analyses])
+    faqs = create_faq(chunks, analyses) if FAQ_ANSWERS else [[] for _ in chunks]
+
+    return [
+        KnowledgeModel(
+            information=chunk,
+            analysis=analysis,
+            embeddings=embedding,
+            source=source,
+            media_type=media_type_from_name(source),
+            chunk_index=index,
+            tenant_id=tenant_id,
+            faq=faq,
+        )
+        for index, (chunk, analysis, embedding, faq) in enumerate(zip(chunks, analyses, embeddings, faqs))
+    ]
+
+
+def knowledge_file_name(transcript_name: str, chunk_index: int, chunks: int) -> str:
+    if chunks == 1:
+        return f"{transcript_name.removesuffix('.txt')}_knowledge.json"
+    return f"{transcript_name.removesuffix('.txt')}_{chunk_index:03d}_knowledge.json"
+
+
 def _main():
     parser = argparse.ArgumentParser()
     parser.add_argument("transcription", help="Transcription to analyze")
@@ -137,14 +456,18 @@ def _main():
         with open(args.transcription, "r") as f:
             transcription = f.read()
 
-        knowledge = create_knowledge(transcription)
+        knowledge_chunks = create_knowledge_chunks(
+            transcription,
+            source=os.path.basename(args.transcription).removesuffix(".txt"),
+        )
 
-        log.info(f"Knowledge analysis: {knowledge.analysis}")
-        with open(
-            f"{args.transcription.rstrip('.txt')}_knowledge.json",
-            "wb",
-        ) as f:
-            f.write(knowledge.model_dump_json().encode("utf-8"))
+        for knowledge in knowledge_chunks:
+            log.info(f"Knowledge analysis: {knowledge.analysis}")
+            with open(
+                knowledge_file_name(args.transcription, knowledge.chunk_index, len(knowledge_chunks)),
+                "wb",
+            ) as f:
+                f.write(knowledge.model_dump_json().encode("utf-8"))
 
     else:
         log.error("No arguments provided")
@@ -162,26 +485,34 @@ def on_new_transcript(cloud_event):
 
     bucket_name = data["bucket"]
     file_name = data["name"]
+    # custom metadata (tenant_id) is passed on to the knowledge files
+    metadata = data.get("metadata") or {}
 
     log.info(f"Processing file: {bucket_name}:{file_name}")
     log.info(f"Event ID: {event_id}, Event type: {event_type}")
+    # failed events of this stage are retried with the traffic, see deadletter.py
+    deadletter.replay_due(STAGE)
+
+    if metadata.get("analysis") == DEFERRED:
+        log.info(f"Analysis of {file_name} is deferred to a batch job")
+        return
 
     if file_name.endswith(".txt"):
+        # results of previous failed attempts
+        results = deadletter.intermediate(STAGE, file_name)
+        knowledge_chunks = [KnowledgeModel(**chunk) for chunk in json.loads(results.get("knowledge", "[]"))]
+
         try:
             # Read file from GCS
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(file_name)
 
-            knowledge = create_knowledge(blob.download_as_string().decode("utf-8"))
-
-            knowledge_file_name = f"{file_name.rstrip('.txt')}_knowledge.json"
-            log.info(f"Saving knowledge analysis to {BUCKET_KNOWLEDGE}:{knowledge_file_name}")
-
-            bucket_knowledge = storage_client.bucket(BUCKET_KNOWLEDGE)
-            knowledge_blob = bucket_knowledge.blob(knowledge_file_name)
-
-            dumps = knowledge.model_dump_json()
-            knowledge_blob.upload_from_string(dumps)
+            if not knowledge_chunks:
+                knowledge_chunks = create_knowledge_chunks(
+                    blob.download_as_string().decode("utf-8"),
+                    source=file_name.removesuffix(".txt"),
+                    tenant_id=metadata.get("tenant_id", ""),
+                )
 
         except UnicodeDecodeError as e:
             log.error(f"Error decoding file: {e}")
@@ -189,8 +520,28 @@ def on_new_transcript(cloud_event):
 
         except Exception as e:
             log.error(f"Error processing file: {e}")
+            deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id)
             return
 
+        try:
+            bucket_knowledge = storage_client.bucket(BUCKET_KNOWLEDGE)
+            for knowledge in knowledge_chunks:
+                # one knowledge file per chunk, each upserted by on_knowledge
+                knowledge_name = knowledge_file_name(file_name, knowledge.chunk_index, len(knowledge_chunks))
+                log.info(f"Saving knowledge analysis to {BUCKET_KNOWLEDGE}:{knowledge_name}")
+
+                knowledge_blob = bucket_knowledge.blob(knowledge_name)
+                knowledge_blob.metadata = metadata or None
+                knowledge_blob.upload_from_string(knowledge.model_dump_json())
+
+        except Exception as e:
+            log.error(f"Error saving knowledge to bucket {BUCKET_KNOWLEDGE}: {e}")
+            knowledge_dump = json.dumps([knowledge.model_dump() for knowledge in knowledge_chunks])
+            deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id, {"knowledge": knowledge_dump})
+            return
+
+        deadletter.resolve(STAGE, file_name)
+
     else:
         log.error(f"File {file_name} is not a transcription")
 
@@ -0,0 +1,474 @@
+"""Deferred analysis of bulk transcripts through batch jobs.
+
+Backfills do not go through the synchronous requests of on_new_transcript. Uploads to
+app/main.py with `X-Analysis: deferred` (or form field analysis=deferred) carry that object
+metadata through the transcript stage and are skipped by on_new_transcript. Transcripts are
+chunked into a job directory, then analyzed and embedded by two batch jobs (Batch API
+JSONL, half the price and a separate rate limit). Finally the knowledge files are written
+to BUCKET_KNOWLEDGE, from where on_knowledge upserts them as usual.
+
+    python batch.py prepare jobs/backfill transcripts/*.txt --tenant acme
+    python batch.py prepare jobs/backfill --bucket $BUCKET_TRANSCRIPTS   # transcripts with analysis=deferred metadata
+    python batch.py run jobs/backfill --wait                            # submit, poll and collect until done
+    python batch.py run jobs/backfill --local --output knowledge/       # stand-in executor, no Batch API
+    python batch.py run jobs/backfill --offline --output knowledge/     # canned responses, no OpenAI at all
+
+The local executor sends the job requests one by one through the scheduler in the BULK
+lane. It shares the rate limits of this process only, interactive requests of the app
+are limited separately (see scheduler.py). The offline executor answers every request
+with a canned, schema-valid analysis or embedding, for dry runs of the job plumbing.
+
+Requests of a phase are split into files within the per-file limits of the Batch API
+(BATCH_MAX_REQUESTS requests, BATCH_MAX_BYTES bytes), each file is submitted as its own batch.
+
+Batch jobs do not answer phrases for the FAQ index, FAQ_ANSWERS only applies to
+on_new_transcript. Knowledge of a batch job has no FAQ answers, the chunks are found by
+the regular search.
+"""
+
+from analyze import (
+    BUCKET_KNOWLEDGE,
+    BUCKET_PROCESSED,
+    DEFERRED,
+    ANALYSIS_BATCH_SIZE,
+    AnalysisModel,
+    KnowledgeModel,
+    analysis_request,
+    analysis_to_text,
+    analyze_batch_with_gpt,
+    chunk_text,
+    create_embeddings,
+    embedding_request,
+    knowledge_file_name,
+    media_type_from_name,
+    openai_client,
+    parse_analysis,
+    storage_client,
+)
+from scheduler import scheduler, BULK
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+MANIFEST = "manifest.jsonl"
+STATE = "state.json"
+
+# chunks of a batched analysis request (analysis_request in analyze.py)
+CHUNK_TAG = re.compile(r'<chunk index="\d+">\n(.*?)\n</chunk>', re.DOTALL)
+
+# per-file limits of the Batch API input
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50_000))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 200 * 1024 * 1024))
+
+# phases of a job, each analysis/embedding phase is one batch
+ANALYSIS = "analysis"
+EMBEDDINGS = "embeddings"
+DONE = "done"
+
+ENDPOINTS = {ANALYSIS: "/v1/responses", EMBEDDINGS: "/v1/embeddings"}
+
+
+def read_jsonl(path: str) -> list[dict]:
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(path: str, records: list[dict]):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def write_requests(job: str, phase: str, requests: list[dict]) -> list[dict]:
+    """Split the requests into batch input files, returns the batches of the phase"""
+    parts, lines, size = [], [], 0
+    for request in requests:
+        line = json.dumps(request, ensure_ascii=False) + "\n"
+        line_size = len(line.encode("utf-8"))
+        if lines and (len(lines) == BATCH_MAX_REQUESTS or size + line_size > BATCH_MAX_BYTES):
+            parts.append(lines)
+            lines, size = [], 0
+        lines.append(line)
+        size += line_size
+    if lines:
+        parts.append(lines)
+
+    batches = []
+    for i, part in enumerate(parts):
+        name = f"{phase}_{i:03d}.jsonl"
+        with open(os.path.join(job, name), "w") as f:
+            f.writelines(part)
+        batches.append({"file": name, "batch_id": None})
+    return batches
+
+
+def output_file(batch: dict) -> str:
+    return batch["file"].replace(".jsonl", "_output.jsonl")
+
+
+def load_state(job: str) -> dict:
+    with open(os.path.join(job, STATE), "r") as f:
+        return json.load(f)
+
+
+def save_state(job: str, state: dict):
+    with open(os.path.join(job, STATE), "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def batch_line(custom_id: str, phase: str, body: dict) -> dict:
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINTS[phase], "body": body}
+
+
+def deferred_transcripts(bucket_name: str, prefix: str = "") -> list[tuple[str, str, dict]]:
+    """(name, text, metadata) of transcripts left in the bucket for a batch job"""
+    transcripts = []
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix or None):
+        metadata = blob.metadata or {}
+        if blob.name.endswith(".txt") and metadata.get("analysis") == DEFERRED:
+            transcripts.append((blob.name, blob.download_as_text(), metadata))
+    return transcripts
+
+
+def prepare(job: str, transcripts: list[tuple[str, str, dict]], bucket: str = ""):
+    """Chunk the transcripts and write the analysis requests of the job"""
+    os.makedirs(job, exist_ok=True)
+    manifest, requests = [], []
+
+    for name, text, metadata in transcripts:
+        chunks = chunk_text(text)
+        for first in range(0, len(chunks), ANALYSIS_BATCH_SIZE):
+            batch = chunks[first : first + ANALYSIS_BATCH_SIZE]
+            custom_id = f"request-{len(manifest)}"
+            manifest.append(
+                {
+                    "custom_id": custom_id,
+                    "transcript": name,
+                    "bucket": bucket,
+                    "metadata": metadata,
+                    "first_index": first,
+                    "total": len(chunks),
+                    "chunks": batch,
+                }
+            )
+            requests.append(batch_line(custom_id, ANALYSIS, analysis_request(batch)))
+
+    write_jsonl(os.path.join(job, MANIFEST), manifest)
+    batches = write_requests(job, ANALYSIS, requests)
+    save_state(job, {"phase": ANALYSIS, "batches": batches, "created_at": datetime.now().isoformat()})
+    log.info(
+        f"Prepared {len(requests)} analysis requests of {len(transcripts)} transcripts in {len(batches)} files in {job}"
+    )
+
+
+class OpenAIExecutor:
+    """Batch API"""
+
+    def submit(self, path: str, endpoint: str) -> str:
+        with open(path, "rb") as f:
+            input_file = openai_client.files.create(file=f, purpose="batch")
+        batch = openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=endpoint,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def result(self, batch_id: str, path: str) -> bool:
+        """Download the output into path once the batch finished, False while it runs"""
+        batch = openai_client.batches.retrieve(batch_id)
+        log.info(f"Batch {batch_id}: {batch.status} {batch.request_counts}")
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return False
+        assert batch.status == "completed", f"Batch {batch_id} {batch.status}: {batch.errors}"
+
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.append(openai_client.files.content(file_id).text)
+        with open(path, "w") as f:
+            f.write("".join(lines))
+        return True
+
+
+class LocalExecutor:
+    """Stand-in for the Batch API, runs the requests right away through the scheduler"""
+
+    def __init__(self, job: str):
+        self.job = job
+
+    def submit(self, path: str, endpoint: str) -> str:
+        create = {
+            "/v1/responses": openai_client.responses.create,
+            "/v1/embeddings": openai_client.embeddings.create,
+        }[endpoint]
+        batch_id = f"local_{os.path.basename(path).removesuffix('.jsonl')}"
+
+        results = []
+        for i, line in enumerate(read_jsonl(path)):
+            result = {"id": f"{batch_id}_{i}", "custom_id": line["custom_id"], "response": None, "error": None}
+            try:
+                response = scheduler.call(create, priority=BULK, **line["body"])
+                result["response"] = {"status_code": 200, "body": response.model_dump(mode="json")}
+            except Exception as e:
+                result["error"] = {"code": e.__class__.__name__, "message": str(e)}
+            results.append(result)
+
+        write_jsonl(os.path.join(self.job, f"{batch_id}.jsonl"), results)
+        return batch_id
+
+    def result(self, batch_id: str, path: str) -> bool:
+        os.replace(os.path.join(self.job, f"{batch_id}.jsonl"), path)
+        return True
+
+
+class OfflineExecutor(LocalExecutor):
+    """Stand-in for the Batch API without OpenAI, canned schema-valid responses of every request"""
+
+    @staticmethod
+    def analysis(chunk: str) -> dict:
+        words = chunk.split()
+        return {"phrases": [" ".join(words[:8])], "keypoints": [" ".join(words[:24])], "language": "en"}
+
+    @staticmethod
+    def embedding(text: str, dimensions: int) -> list[float]:
+        # the same text gets the same unit vector, so dedupe and search behave consistently
+        rng = random.Random(zlib.crc32(text.encode("utf-8")))
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def response(self, endpoint: str, body: dict) -> dict:
+        if endpoint == "/v1/embeddings":
+            data = [
+                {"object": "embedding", "index": i, "embedding": self.embedding(text, body["dimensions"])}
+                for i, text in enumerate(body["input"])
+            ]
+            usage = {"prompt_tokens": 0, "total_tokens": 0}
+            return {"object": "list", "model": body["model"], "data": data, "usage": usage}
+
+        if body["text"]["format"]["name"] == "probable_questions":
+            text = json.dumps(self.analysis(body["input"]))
+        else:
+            chunks = CHUNK_TAG.findall(body["input"])
+            analyses = [self.analysis(chunk) for chunk in chunks]
+            text = json.dumps({"analyses": analyses})
+        message = {"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}
+        return {"object": "response", "model": body["model"], "status": "completed", "output": [message]}
+
+    def submit(self, path: str, endpoint: str) -> str:
+        batch_id = f"offline_{os.path.basename(path).removesuffix('.jsonl')}"
+        results = [
+            {
+                "id": f"{batch_id}_{i}",
+                "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "body": self.response(endpoint, line["body"])},
+                "error": None,
+            }
+            for i, line in enumerate(read_jsonl(path))
+        ]
+        write_jsonl(os.path.join(self.job, f"{batch_id}.jsonl"), results)
+        return batch_id
+
+
+def read_output(job: str, batches: list[dict]) -> dict[str, dict]:
+    """Response bodies of successful requests of all batches by custom id"""
+    bodies = {}
+    for result in (result for batch in batches for result in read_jsonl(os.path.join(job, output_file(batch)))):
+        response = result.get("response") or {}
+        if response.get("status_code") == 200:
+            bodies[result["custom_id"]] = response["body"]
+        else:
+            log.warning(f"Request {result['custom_id']} failed: {result.get('error') or response}")
+    return bodies
+
+
+def output_text(body: dict) -> str:
+    """Text of a Responses API body, read without validating the whole response schema"""
+    return "".join(
+        content.get("text", "")
+        for item in body.get("output", [])
+        if item.get("type") == "message"
+        for content in item.get("content", [])
+        if content.get("type") == "output_text"
+    )
+
+
+def embeddings_of(body: dict) -> list[list[float]]:
+    return [item["embedding"] for item in sorted(body.get("data", []), key=lambda item: item["index"])]
+
+
+def collect_analyses(job: str, manifest: list[dict], batches: list[dict]) -> list[dict]:
+    """Analysis results, failed or incomplete requests are analyzed synchronously"""
+    bodies = read_output(job, batches)
+    results = []
+    for item in manifest:
+        analyses = []
+        if item["custom_id"] in bodies:
+            try:
+                analyses = parse_analysis(output_text(bodies[item["custom_id"]]), len(item["chunks"]))
+            except Exception as e:
+                log.warning(f"Invalid analysis of {item['custom_id']}: {e}")
+        if len(analyses) != len(item["chunks"]):
+            log.info(f"Analyzing {item['custom_id']} ({item['transcript']}) synchronously")
+            analyses = analyze_batch_with_gpt(item["chunks"])
+        results.append({"custom_id": item["custom_id"], "analyses": [analysis.model_dump() for analysis in analyses]})
+    return results
+
+
+def write_knowledge(item: dict, analyses: list[AnalysisModel], embeddings: list[list[float]], output: str | None):
+    source = item["transcript"].removesuffix(".txt")
+    metadata = {key: value for key, value in item["metadata"].items() if key != "analysis"}
+
+    for offset, (chunk, analysis, embedding) in enumerate(zip(item["chunks"], analyses, embeddings)):
+        chunk_index = item["first_index"] + offset
+        knowledge = KnowledgeModel(
+            information=chunk,
+            analysis=analysis,
+            embeddings=embedding,
+            source=source,
+            media_type=media_type_from_name(source),
+            chunk_index=chunk_index,
+            tenant_id=metadata.get("tenant_id", ""),
+        )
+        knowledge_name = knowledge_file_name(item["transcript"], chunk_index, item["total"])
+
+        if output:
+            with open(os.path.join(output, os.path.basename(knowledge_name)), "w") as f:
+                f.write(knowledge.model_dump_json())
+        else:
+            blob = storage_client.bucket(BUCKET_KNOWLEDGE).blob(knowledge_name)
+            blob.metadata = metadata or None
+            blob.upload_from_string(knowledge.model_dump_json())
+
+
+def archive(manifest: list[dict]):
+    """Move deferred transcripts of the job to the processed bucket"""
+    for name, bucket in {(item["transcript"], item["bucket"]) for item in manifest if item["bucket"]}:
+        try:
+            source = storage_client.bucket(bucket)
+            blob = source.blob(name)
+            new_name = f"{datetime.now().strftime('%y%m%d_%H%M%S')}_{name}"
+            source.copy_blob(blob, storage_client.bucket(BUCKET_PROCESSED), new_name)
+            blob.delete()
+        except Exception as e:
+            log.error(f"Error archiving transcript {bucket}/{name}: {e}")
+
+
+def collect_knowledge(job: str, manifest: list[dict], batches: list[dict], output: str | None):
+    analyses = {result["custom_id"]: result["analyses"] for result in read_jsonl(os.path.join(job, "analyses.jsonl"))}
+    bodies = read_output(job, batches)
+
+    for item in manifest:
+        item_analyses = [AnalysisModel(**analysis) for analysis in analyses[item["custom_id"]]]
+        embeddings = []
+        if item["custom_id"] in bodies:
+            embeddings = embeddings_of(bodies[item["custom_id"]])
+        if len(embeddings) != len(item_analyses):
+            log.info(f"Embedding {item['custom_id']} ({item['transcript']}) synchronously")
+            embeddings = create_embeddings([analysis_to_text(analysis) for analysis in item_analyses])
+        write_knowledge(item, item_analyses, embeddings, output)
+
+    if not output:
+        archive(manifest)
+    log.info(f"Wrote knowledge of {len(manifest)} requests to {output or BUCKET_KNOWLEDGE}")
+
+
+def step(job: str, executor, output: str | None = None) -> bool:
+    """Advance the job as far as possible without waiting, True when done"""
+    state = load_state(job)
+    manifest = read_jsonl(os.path.join(job, MANIFEST))
+
+    while state["phase"] != DONE:
+        phase, batches = state["phase"], state["batches"]
+        for batch in batches:
+            if not batch["batch_id"]:
+                batch["batch_id"] = executor.submit(os.path.join(job, batch["file"]), ENDPOINTS[phase])
+                # saved per batch, a crash does not submit the same file twice
+                save_state(job, state)
+                log.info(f"Submitted {phase} batch {batch['batch_id']} ({batch['file']})")
+
+        # outputs already downloaded are not fetched again
+        pending = [batch for batch in batches if not os.path.exists(os.path.join(job, output_file(batch)))]
+        finished = [executor.result(batch["batch_id"], os.path.join(job, output_file(batch))) for batch in pending]
+        if not all(finished):
+            return False
+
+        if phase == ANALYSIS:
+            results = collect_analyses(job, manifest, batches)
+            write_jsonl(os.path.join(job, "analyses.jsonl"), results)
+            requests = [
+                batch_line(
+                    result["custom_id"],
+                    EMBEDDINGS,
+                    embedding_request([analysis_to_text(AnalysisModel(**analysis)) for analysis in result["analyses"]]),
+                )
+                for result in results
+            ]
+            state.update(phase=EMBEDDINGS, batches=write_requests(job, EMBEDDINGS, requests))
+        else:
+            collect_knowledge(job, manifest, batches, output)
+            state.update(phase=DONE, batches=[])
+        save_state(job, state)
+
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deferred analysis of transcripts through batch jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = commands.add_parser("prepare", help="Chunk transcripts into a new job")
+    prepare_parser.add_argument("job", help="Job directory")
+    prepare_parser.add_argument("transcripts", nargs="*", help="Local transcript files")
+    prepare_parser.add_argument("--bucket", help="Collect deferred transcripts from this bucket")
+    prepare_parser.add_argument("--prefix", default="", help="Name prefix of transcripts in the bucket")
+    prepare_parser.add_argument("--tenant", default="", help="Tenant of local transcript files")
+
+    run_parser = commands.add_parser("run", help="Submit, poll and collect the job")
+    run_parser.add_argument("job", help="Job directory")
+    executors = run_parser.add_mutually_exclusive_group()
+    executors.add_argument("--local", action="store_true", help="Run requests locally instead of the Batch API")
+    executors.add_argument("--offline", action="store_true", help="Answer requests with canned responses, no OpenAI")
+    run_parser.add_argument("--wait", action="store_true", help="Poll until the job is done")
+    run_parser.add_argument("--poll", type=int, default=60, help="Seconds between polls")
+    run_parser.add_argument("--output", help="Write knowledge files to this directory instead of BUCKET_KNOWLEDGE")
+
+    status_parser = commands.add_parser("status", help="Show the phase of the job")
+    status_parser.add_argument("job", help="Job directory")
+
+    args = parser.parse_args()
+
+    if args.command == "prepare":
+        if args.bucket:
+            transcripts = deferred_transcripts(args.bucket, args.prefix)
+        else:
+            metadata = {"tenant_id": args.tenant} if args.tenant else {}
+            transcripts = []
+            for path in args.transcripts:
+                with open(path, "r") as f:
+                    transcripts.append((os.path.basename(path), f.read(), metadata))
+        assert transcripts, "No transcripts to prepare"
+        prepare(args.job, transcripts, args.bucket or "")
+    elif args.command == "run":
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+        if args.offline:
+            executor = OfflineExecutor(args.job)
+        elif args.local:
+            executor = LocalExecutor(args.job)
+        else:
+            executor = OpenAIExecutor()
+        while not step(args.job, executor, args.output) and args.wait:
+            time.sleep(args.poll)
+        print(f"Job {args.job}: {load_state(args.job)['phase']}")
+    elif args.command == "status":
+        print(json.dumps(load_state(args.job), indent=2))
@@ -0,0 +1,342 @@
+"""Rate-limit-aware scheduler for OpenAI requests.
+
+Every OpenAI call goes through `scheduler.call` (or `scheduler.acall` for async clients):
+- token buckets per model for requests/min and tokens/min,
+- priority lanes, waiting INTERACTIVE requests go before BULK ones,
+- retries of 429/5xx/connection errors with jittered exponential backoff.
+
+With SCHEDULER_REDIS_URL set, buckets and lanes are kept in Redis and shared by every
+instance of the app, utils and the functions (pip install redis). INTERACTIVE callers
+(app, utils/qdrant.py) then take priority over BULK callers (the functions) across the
+deployment, and all of them together stay within the account limits.
+
+Without it buckets and lanes live in process memory: every process gets the full limits
+on its own and lanes only order requests of the same process. Split the account limits
+between instances with RATE_LIMIT_SHARE (fraction of the limits one process may use,
+e.g. 0.2 for five instances), 429s beyond that are retried.
+
+Limits can be overridden per model, e.g. RATE_LIMIT_GPT_4O_MINI="500,200000" (requests/min, tokens/min).
+This module is copied into every function directory, keep the copies in sync.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import openai
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = (INTERACTIVE, BULK)
+
+# requests per minute, tokens per minute (0 = unlimited)
+DEFAULT_LIMITS = {
+    "gpt-4o": (500, 30_000),
+    "gpt-4o-mini": (500, 200_000),
+    "text-embedding-3-small": (3_000, 1_000_000),
+    "whisper-1": (50, 0),
+}
+FALLBACK_LIMITS = (500, 200_000)
+# fraction of the account limits used by this process, see above, not applied to shared limits
+RATE_LIMIT_SHARE = float(os.getenv("RATE_LIMIT_SHARE", 1.0))
+# limits and lanes shared by all processes through Redis, e.g. redis://10.0.0.3:6379/0
+SCHEDULER_REDIS_URL = os.getenv("SCHEDULER_REDIS_URL", "")
+# prefix of the Redis keys, deployments sharing one Redis server need their own
+SCHEDULER_REDIS_PREFIX = os.getenv("SCHEDULER_REDIS_PREFIX", "scheduler")
+
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", 1.0))
+BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", 60.0))
+# how often a lower priority request checks whether the higher lanes are empty
+POLL_INTERVAL = 0.05
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def parse_limits(name: str, value: str) -> tuple[int, int]:
+    """Requests/min and tokens/min of a RATE_LIMIT_<MODEL> override"""
+    try:
+        rpm, tpm = (int(limit) for limit in value.split(","))
+    except ValueError:
+        rpm = tpm = -1
+    if rpm < 0 or tpm < 0:
+        raise ValueError(f'{name}="{value}" is invalid, expected "<requests/min>,<tokens/min>" (0 = unlimited)')
+    return rpm, tpm
+
+
+def check_limit_overrides():
+    # malformed overrides fail on import, not on the first request of their model
+    for name, value in os.environ.items():
+        if name.startswith("RATE_LIMIT_") and name != "RATE_LIMIT_SHARE":
+            parse_limits(name, value)
+
+
+check_limit_overrides()
+
+
+def model_limits(model: str, share: float = 1.0) -> tuple[int, int]:
+    name = f"RATE_LIMIT_{model.upper().replace('-', '_').replace('.', '_')}"
+    if value := os.getenv(name):
+        rpm, tpm = parse_limits(name, value)
+    else:
+        rpm, tpm = DEFAULT_LIMITS.get(model, FALLBACK_LIMITS)
+    # 0 stays unlimited, a share never rounds a limit down to 0
+    return tuple(max(1, int(limit * share)) if limit else 0 for limit in (rpm, tpm))
+
+
+def estimate_tokens(*texts) -> int:
+    """Rough token estimate (~4 characters per token) used for the tokens/min bucket"""
+    return sum(len(str(text)) for text in texts if text) // 4
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # requests bigger than the bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+    def drain(self):
+        self.level = min(self.level, 0.0)
+
+
+class LocalLimiter:
+    """Buckets and lanes of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: dict[str, list[TokenBucket]] = {}
+        self._waiting: dict[str, list[int]] = {}
+
+    def _model_state(self, model: str) -> tuple[list[TokenBucket], list[int]]:
+        if model not in self._buckets:
+            rpm, tpm = model_limits(model, RATE_LIMIT_SHARE)
+            self._buckets[model] = [TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None]
+            self._waiting[model] = [0 for _ in PRIORITIES]
+        return self._buckets[model], self._waiting[model]
+
+    def enter(self, model: str, priority: int) -> str:
+        with self._lock:
+            self._model_state(model)[1][priority] += 1
+        return ""
+
+    def leave(self, model: str, priority: int, waiter: str):
+        with self._lock:
+            self._model_state(model)[1][priority] -= 1
+
+    def try_acquire(self, model: str, tokens: int, priority: int, waiter: str) -> float:
+        """Take capacity for one request, return 0 on success or seconds to wait"""
+        with self._lock:
+            (requests_bucket, tokens_bucket), waiting = self._model_state(model)
+            if any(waiting[lane] for lane in PRIORITIES if lane < priority):
+                return POLL_INTERVAL
+
+            now = time.monotonic()
+            demands = [(bucket, amount) for bucket, amount in ((requests_bucket, 1), (tokens_bucket, tokens)) if bucket]
+            wait = max([bucket.wait_time(amount, now) for bucket, amount in demands], default=0.0)
+            if wait > 0:
+                return wait
+
+            for bucket, amount in demands:
+                bucket.take(amount)
+            return 0.0
+
+    def rate_limited(self, model: str):
+        with self._lock:
+            for bucket in self._model_state(model)[0]:
+                if bucket:
+                    bucket.drain()
+
+
+# KEYS: requests bucket, tokens bucket, waiters of the own lane, waiters of higher lanes...
+# ARGV: requests/min, tokens/min, tokens of the request, waiter id, seconds a waiter stays registered
+# Same token buckets as TokenBucket, on the clock of the Redis server. Waiters are kept with an
+# expiry, so lanes of crashed processes do not block lower lanes for good.
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('ZADD', KEYS[3], now + tonumber(ARGV[5]), ARGV[4])
+for i = 4, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    if redis.call('ZCARD', KEYS[i]) > 0 then
+        return 'lane'
+    end
+end
+
+local limits = {{KEYS[1], tonumber(ARGV[1]), 1}, {KEYS[2], tonumber(ARGV[2]), tonumber(ARGV[3])}}
+local levels = {}
+local wait = 0
+for i, limit in ipairs(limits) do
+    local capacity = limit[2]
+    if capacity > 0 then
+        local state = redis.call('HMGET', limit[1], 'level', 'updated')
+        local level = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        level = math.min(capacity, level + (now - updated) * capacity / 60)
+        local amount = math.min(limit[3], capacity)
+        levels[i] = level - amount
+        if level < amount then
+            wait = math.max(wait, (amount - level) * 60 / capacity)
+        end
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+
+for i, limit in ipairs(limits) do
+    if limit[2] > 0 then
+        redis.call('HSET', limit[1], 'level', tostring(levels[i]), 'updated', tostring(now))
+        -- a bucket untouched for a minute is full again
+        redis.call('EXPIRE', limit[1], 120)
+    end
+end
+redis.call('ZREM', KEYS[3], ARGV[4])
+return '0'
+"""
+
+# KEYS: buckets of the model, emptied after a 429 so no process sends more until they refill
+DRAIN_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+for i = 1, #KEYS do
+    -- a bucket not seen before counts as full
+    local level = tonumber(redis.call('HGET', KEYS[i], 'level'))
+    if level == nil or level > 0 then
+        redis.call('HSET', KEYS[i], 'level', '0', 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[i], 120)
+    end
+end
+return 0
+"""
+
+
+class RedisLimiter:
+    """Buckets and lanes shared by all processes through Redis"""
+
+    # a waiter that stopped polling (crashed process) leaves its lane after this many seconds
+    WAITER_TTL = 10
+
+    def __init__(self, url: str, prefix: str = SCHEDULER_REDIS_PREFIX):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._acquire = self._redis.register_script(ACQUIRE_SCRIPT)
+        self._drain = self._redis.register_script(DRAIN_SCRIPT)
+
+    def _key(self, model: str, name: str) -> str:
+        return f"{self._prefix}:{model}:{name}"
+
+    def enter(self, model: str, priority: int) -> str:
+        # registered by the first try_acquire, which follows right away
+        return uuid.uuid4().hex
+
+    def leave(self, model: str, priority: int, waiter: str):
+        self._redis.zrem(self._key(model, f"waiting:{priority}"), waiter)
+
+    def try_acquire(self, model: str, tokens: int, priority: int, waiter: str) -> float:
+        rpm, tpm = model_limits(model)
+        keys = [self._key(model, "requests"), self._key(model, "tokens"), self._key(model, f"waiting:{priority}")]
+        keys += [self._key(model, f"waiting:{lane}") for lane in PRIORITIES if lane < priority]
+        result = self._acquire(keys=keys, args=[rpm, tpm, tokens, waiter, self.WAITER_TTL]).decode()
+        if result == "lane":
+            return POLL_INTERVAL
+        # polled at least every WAITER_TTL / 2 seconds, so the waiter stays registered
+        return min(float(result), self.WAITER_TTL / 2)
+
+    def rate_limited(self, model: str):
+        self._drain(keys=[self._key(model, "requests"), self._key(model, "tokens")])
+
+
+class Scheduler:
+    def __init__(self, limiter: LocalLimiter | RedisLimiter | None = None):
+        self.limiter = limiter or LocalLimiter()
+
+    def acquire(self, model: str, tokens: int = 0, priority: int = BULK):
+        waiter = self.limiter.enter(model, priority)
+        try:
+            while (wait := self.limiter.try_acquire(model, tokens, priority, waiter)) > 0:
+                time.sleep(wait)
+        finally:
+            self.limiter.leave(model, priority, waiter)
+
+    async def aacquire(self, model: str, tokens: int = 0, priority: int = BULK):
+        waiter = self.limiter.enter(model, priority)
+        try:
+            while (wait := self.limiter.try_acquire(model, tokens, priority, waiter)) > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self.limiter.leave(model, priority, waiter)
+
+    def _retry_delay(self, error: Exception, attempt: int, model: str) -> float:
+        if isinstance(error, openai.RateLimitError):
+            self.limiter.rate_limited(model)
+
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after:
+                return float(retry_after) + random.uniform(0, BACKOFF_BASE)
+        except ValueError:
+            pass
+
+        # full jitter exponential backoff
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+    def call(self, create, /, *, priority: int = BULK, estimated_tokens: int = 0, **kwargs):
+        """Call OpenAI `create` method (e.g. client.responses.create) within the model rate limits"""
+        model = kwargs.get("model", "")
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(model, estimated_tokens, priority)
+            try:
+                return create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = self._retry_delay(e, attempt, model)
+                log.warning(f"{model} request failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+
+    async def acall(self, create, /, *, priority: int = BULK, estimated_tokens: int = 0, **kwargs):
+        """Async variant of `call` for AsyncOpenAI clients"""
+        model = kwargs.get("model", "")
+        for attempt in range(MAX_RETRIES + 1):
+            await self.aacquire(model, estimated_tokens, priority)
+            try:
+                return await create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = self._retry_delay(e, attempt, model)
+                log.warning(f"{model} request failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+# shared by all OpenAI calls of the process
+scheduler = Scheduler(RedisLimiter(SCHEDULER_REDIS_URL) if SCHEDULER_REDIS_URL else LocalLimiter())
@@ -0,0 +1,83 @@
+"""Transcripts cached by content hash of the source file.
+
+The source is hashed (sha256) while it is downloaded. A transcript already stored in
+BUCKET_CACHE under <kind>/<sha256>.txt is copied to the transcripts bucket instead of
+transcribing the same audio or document again.
+
+This module is copied into every function directory that uses it, keep the copies in sync.
+"""
+
+import hashlib
+import io
+import logging
+import os
+
+from google.cloud import storage
+
+log = logging.getLogger(__name__)
+
+BUCKET_CACHE = os.getenv("BUCKET_CACHE")
+
+TRANSCRIPTS = "transcripts"
+DOCUMENTS = "documents"
+
+if not BUCKET_CACHE:
+    log.warning("BUCKET_CACHE environment variable is not set, transcripts will not be cached")
+
+
+class HashingBuffer(io.BytesIO):
+    """In-memory file hashing everything written to it"""
+
+    def __init__(self):
+        super().__init__()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        return super().write(data)
+
+
+def download_with_hash(blob: storage.Blob) -> tuple[bytes, str]:
+    """Download blob content and its sha256 hex digest in one pass"""
+    buffer = HashingBuffer()
+    blob.download_to_file(buffer)
+    return buffer.getvalue(), buffer.sha256.hexdigest()
+
+
+def cache_name(kind: str, digest: str) -> str:
+    return f"{kind}/{digest}.txt"
+
+
+def copy_cached(kind: str, digest: str, bucket: str, name: str, metadata: dict | None = None) -> bool:
+    """Copy a cached transcript to bucket/name, False if there is none"""
+    if not BUCKET_CACHE:
+        return False
+
+    try:
+        client = storage.Client()
+        cached = client.bucket(BUCKET_CACHE).blob(cache_name(kind, digest))
+        if not cached.exists():
+            return False
+        # server side copy, the transcript is not downloaded; metadata of the new object is
+        # set in the same request, so the trigger of the next stage already sees it
+        destination = client.bucket(bucket).blob(name)
+        destination.metadata = metadata or None
+        token, _, _ = destination.rewrite(cached)
+        while token:
+            token, _, _ = destination.rewrite(cached, token=token)
+        log.info(f"Cache hit {kind}/{digest[:12]}, copied to {bucket}/{name}")
+        return True
+    except Exception as e:
+        log.error(f"Error reading cached transcript {kind}/{digest}: {e}")
+        return False
+
+
+def store(kind: str, digest: str, transcription: str):
+    if not BUCKET_CACHE:
+        return
+
+    try:
+        storage.Client().bucket(BUCKET_CACHE).blob(cache_name(kind, digest)).upload_from_string(transcription)
+        log.info(f"Cached transcript {kind}/{digest[:12]}")
+    except Exception as e:
+        log.error(f"Error caching transcript {kind}/{digest}: {e}")
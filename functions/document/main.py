@@ -9,6 +9,9 @@ import time
 import base64
 from datetime import datetime
 import openai
+from scheduler import scheduler, estimate_tokens, BULK
+import deadletter
+import cache
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -39,12 +42,16 @@ assert OPENAI_API_KEY, "OPENAI_API_KEY environment variable is not set"
 
 
 # Initialize OpenAI client
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# retries are handled by the scheduler
+openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 
 # Initialize Google Cloud Storage client
 storage_client = storage.Client()
 
+# name of this pipeline stage in dead-letter records
+STAGE = "document"
+
 
 ANALYZER_SYSTEM_PROMPT = f"""
 You are an AI assistant that analyzes documents.
@@ -61,7 +68,11 @@ Current date and time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 def transcribe_pdf(file_content: bytes) -> str:
     base64_string = base64.b64encode(file_content).decode("utf-8")
 
-    response = openai_client.responses.create(
+    response = scheduler.call(
+        openai_client.responses.create,
+        priority=BULK,
+        # tokens of the file are not known before parsing
+        estimated_tokens=estimate_tokens(ANALYZER_SYSTEM_PROMPT),
         model="gpt-4o-mini",
         input=[
             {"role": "system", "content": ANALYZER_SYSTEM_PROMPT},
@@ -77,12 +88,11 @@ def transcribe_pdf(file_content: bytes) -> str:
             },
         ],
     )
-    try:
-        return response.output_text
-
-    except Exception as e:
-        log.error(f"Error analyzing file: {e}")
-        return str(response)
+    # a failed analysis raises, so it goes to the dead-letter bucket and is never cached
+    transcription = response.output_text
+    if not transcription.strip():
+        raise ValueError(f"Analysis of file returned no text (status {response.status})")
+    return transcription
 
 
 def _main():
@@ -111,9 +121,13 @@ def on_document(cloud_event):
 
     bucket_name = data["bucket"]
     file_name = data["name"]
+    # custom metadata (tenant_id) is passed on to the transcript
+    metadata = data.get("metadata") or {}
 
     log.info(f"Processing file: {bucket_name}:{file_name}")
     log.info(f"Event ID: {event_id}, Event type: {event_type}")
+    # failed events of this stage are retried with the traffic, see deadletter.py
+    deadletter.replay_due(STAGE)
 
     BUCKET_TRANSCRIPTS = os.getenv("BUCKET_TRANSCRIPTS")
     BUCKET_PROCESSED = os.getenv("BUCKET_PROCESSED")
@@ -125,31 +139,45 @@ def on_document(cloud_event):
             # Read file from GCS
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(file_name)
-            pdf_bytes = blob.download_as_bytes()
+            pdf_bytes, digest = cache.download_with_hash(blob)
         except Exception as e:
             log.error(f"Error reading file {file_name}: {e}")
             log.error("File not longer exists")
             return
 
-        try:
-            transcription = transcribe_pdf(pdf_bytes)
-            log.info(f"Transcription: {transcription[:100]}...")
-
-        except Exception as e:
-            log.error(f"Error transcribing file {file_name}: {e}")
-            return
-
-        try:
-            bucket_transcripts = storage_client.bucket(BUCKET_TRANSCRIPTS)
-            # save transcription to new file
-            new_blob = bucket_transcripts.blob(f"{file_name}.txt")
-            new_blob.upload_from_string(transcription)
-        except Exception as e:
-            log.error(f"Error saving transcription to bucket {BUCKET_TRANSCRIPTS}: {e}")
-            log.error(f"{file_name}: {e}")
-            return
+        # results of previous failed attempts
+        results = deadletter.intermediate(STAGE, file_name)
+
+        # same document transcribed before, the cached transcript goes straight to the transcripts bucket
+        cached = not results and cache.copy_cached(
+            cache.DOCUMENTS, digest, BUCKET_TRANSCRIPTS, f"{file_name}.txt", metadata
+        )
+        if not cached:
+            try:
+                transcription = results.get("transcription") or transcribe_pdf(pdf_bytes)
+                log.info(f"Transcription: {transcription[:100]}...")
+
+            except Exception as e:
+                log.error(f"Error transcribing file {file_name}: {e}")
+                deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id)
+                return
+
+            try:
+                bucket_transcripts = storage_client.bucket(BUCKET_TRANSCRIPTS)
+                # save transcription to new file
+                new_blob = bucket_transcripts.blob(f"{file_name}.txt")
+                new_blob.metadata = metadata or None
+                new_blob.upload_from_string(transcription)
+            except Exception as e:
+                log.error(f"Error saving transcription to bucket {BUCKET_TRANSCRIPTS}: {e}")
+                log.error(f"{file_name}: {e}")
+                deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id, {"transcription": transcription})
+                return
+
+            cache.store(cache.DOCUMENTS, digest, transcription)
 
         log.info(f"Transcription saved to {BUCKET_TRANSCRIPTS}/{file_name}.txt")
+        deadletter.resolve(STAGE, file_name)
 
     else:
         log.warning(f"File {file_name} is not an audio file")
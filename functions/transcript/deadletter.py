@@ -0,0 +1,190 @@
+"""Dead-letter records of failed pipeline events.
+
+A handler which fails records the stage, source object, error and any intermediate
+results already computed (e.g. the transcription) in BUCKET_DEADLETTER and leaves the
+source object in place. Once its backoff expired the event is re-triggered by the next
+event of the same stage (replay_due) or by `python utils/deadletter.py --replay`, which
+covers stages without traffic; the handler then reuses the saved intermediate results
+instead of computing them again.
+
+This module is copied into every function directory, keep the copies in sync.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage
+from pydantic import BaseModel
+
+log = logging.getLogger(__name__)
+
+BUCKET_DEADLETTER = os.getenv("BUCKET_DEADLETTER")
+MAX_ATTEMPTS = int(os.getenv("DEADLETTER_MAX_ATTEMPTS", 5))
+# seconds before the first replay, doubled with every failed attempt
+RETRY_BACKOFF = int(os.getenv("DEADLETTER_BACKOFF", 300))
+# due records of its stage replayed by every event, 0 leaves replays to utils/deadletter.py
+REPLAY_ON_TRIGGER = int(os.getenv("DEADLETTER_REPLAY_ON_TRIGGER", 3))
+
+RETRY = "retry"
+DEAD = "dead"
+
+if not BUCKET_DEADLETTER:
+    log.warning("BUCKET_DEADLETTER environment variable is not set, failed events will not be recorded")
+
+
+class DeadLetterModel(BaseModel):
+    stage: str
+    bucket: str
+    name: str
+    event_id: str = ""
+    attempts: int = 0
+    status: str = RETRY
+    error: str = ""
+    failed_at: datetime
+    next_attempt_at: datetime
+    intermediate: dict[str, str] = {}
+
+
+def record_name(stage: str, name: str) -> str:
+    return f"{stage}/{name}.json"
+
+
+def _blob(stage: str, name: str) -> storage.Blob:
+    return storage.Client().bucket(BUCKET_DEADLETTER).blob(record_name(stage, name))
+
+
+def _save(blob: storage.Blob, record: DeadLetterModel, **kwargs):
+    # status and next attempt also as metadata, so listing the records tells which are due
+    blob.metadata = {"status": record.status, "next_attempt_at": record.next_attempt_at.isoformat()}
+    blob.upload_from_string(record.model_dump_json(), content_type="application/json", **kwargs)
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def load(stage: str, name: str) -> DeadLetterModel | None:
+    if not BUCKET_DEADLETTER:
+        return None
+
+    blob = _blob(stage, name)
+    if not blob.exists():
+        return None
+    return DeadLetterModel.model_validate_json(blob.download_as_text())
+
+
+def intermediate(stage: str, name: str) -> dict[str, str]:
+    """Intermediate results saved by previous failed attempts"""
+    try:
+        record = load(stage, name)
+    except Exception as e:
+        log.error(f"Error loading dead-letter record {stage}:{name}: {e}")
+        return {}
+
+    if record and record.intermediate:
+        log.info(f"Reusing {list(record.intermediate)} from attempt {record.attempts} of {stage}:{name}")
+        return record.intermediate
+    return {}
+
+
+def record_failure(
+    stage: str,
+    bucket: str,
+    name: str,
+    error: Exception,
+    event_id: str = "",
+    results: dict[str, str] | None = None,
+) -> DeadLetterModel | None:
+    """Record failed event, keeping intermediate results of previous attempts"""
+    if not BUCKET_DEADLETTER:
+        return None
+
+    try:
+        now = datetime.now(timezone.utc)
+        record = load(stage, name) or DeadLetterModel(
+            stage=stage,
+            bucket=bucket,
+            name=name,
+            failed_at=now,
+            next_attempt_at=now,
+        )
+        record.event_id = event_id
+        record.attempts += 1
+        record.error = f"{error.__class__.__name__}: {error}"
+        record.failed_at = now
+        record.next_attempt_at = now + backoff(record.attempts)
+        record.status = DEAD if record.attempts >= MAX_ATTEMPTS else RETRY
+        record.intermediate.update(results or {})
+
+        _save(_blob(stage, name), record)
+        log.warning(f"Recorded failure {record.attempts}/{MAX_ATTEMPTS} of {stage}:{name} ({record.status})")
+        return record
+
+    except Exception as e:
+        log.error(f"Error recording dead-letter record {stage}:{name}: {e}")
+        return None
+
+
+def resolve(stage: str, name: str):
+    """Remove the record after the event was processed successfully"""
+    if not BUCKET_DEADLETTER:
+        return
+
+    try:
+        blob = _blob(stage, name)
+        if blob.exists():
+            blob.delete()
+            log.info(f"Resolved dead-letter record {stage}:{name}")
+    except Exception as e:
+        log.error(f"Error resolving dead-letter record {stage}:{name}: {e}")
+
+
+def _is_due(blob: storage.Blob, now: datetime) -> bool:
+    metadata = blob.metadata or {}
+    # records written without metadata are read to find out
+    if "next_attempt_at" not in metadata:
+        record = DeadLetterModel.model_validate_json(blob.download_as_text())
+        metadata = {"status": record.status, "next_attempt_at": record.next_attempt_at.isoformat()}
+    return metadata["status"] == RETRY and datetime.fromisoformat(metadata["next_attempt_at"]) <= now
+
+
+def replay_due(stage: str, limit: int = REPLAY_ON_TRIGGER) -> int:
+    """Re-trigger up to limit records of the stage whose backoff expired, returns their number"""
+    if not BUCKET_DEADLETTER or not limit:
+        return 0
+
+    replayed = 0
+    try:
+        client = storage.Client()
+        now = datetime.now(timezone.utc)
+        for blob in client.list_blobs(BUCKET_DEADLETTER, prefix=f"{stage}/"):
+            if replayed >= limit:
+                break
+            if not _is_due(blob, now):
+                continue
+
+            # claimed for another backoff period, so the replayed event itself and other
+            # instances skip it; a failed replay records the next attempt as usual
+            record = DeadLetterModel.model_validate_json(blob.download_as_text())
+            record.next_attempt_at = now + backoff(record.attempts)
+            try:
+                _save(blob, record, if_generation_match=blob.generation)
+            except PreconditionFailed:
+                continue
+
+            bucket = client.bucket(record.bucket)
+            source = bucket.get_blob(record.name)
+            if source is None:
+                log.warning(f"Source {record.bucket}:{record.name} of {stage} record no longer exists, dropping it")
+                blob.delete()
+                continue
+            # new generation of the object fires the finalize trigger of the stage again
+            bucket.copy_blob(source, bucket, record.name)
+            replayed += 1
+            log.info(f"Replayed {stage}:{record.name} (attempts: {record.attempts})")
+
+    except Exception as e:
+        log.error(f"Error replaying dead-letter records of {stage}: {e}")
+    return replayed
@@ -4,7 +4,14 @@ import openai
 from google.cloud import storage, secretmanager
 import dotenv
 import os
+import re
+import shutil
+import subprocess
+import tempfile
 from datetime import datetime
+from scheduler import scheduler, BULK
+import deadletter
+import cache
 
 dotenv.load_dotenv()
 
@@ -29,23 +36,92 @@ assert OPENAI_API_KEY, "OPENAI_API_KEY environment variable is not set"
 
 
 # Initialize OpenAI client
-openai_aclient = openai.OpenAI(api_key=OPENAI_API_KEY)
+# retries are handled by the scheduler
+openai_aclient = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 
 # Initialize Google Cloud Storage client
 storage_client = storage.Client()
 
-
-def transcribe_audio(file_content: bytes) -> list[str]:
-    audio_file = open("audio.mp3", "wb")
-    audio_file.write(file_content)
-    audio_file.close()
-
-    with open("audio.mp3", "rb") as audio_file:
-        transcription = openai_aclient.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-        )
+# name of this pipeline stage in dead-letter records
+STAGE = "transcript"
+
+# Audio is downmixed to 16 kHz mono (what whisper uses internally), trimmed of leading
+# and trailing silence, pauses are shortened and it is re-encoded to opus before upload,
+# requires ffmpeg
+NORMALIZE_AUDIO = os.getenv("NORMALIZE_AUDIO", "1") == "1"
+NORMALIZED_BITRATE = os.getenv("NORMALIZED_BITRATE", "24k")
+SILENCE_THRESHOLD = os.getenv("SILENCE_THRESHOLD", "-50dB")
+
+# live recordings of app/main.py, segments of running sessions and archives of transcribed ones
+RECORDINGS_FOLDER = "recordings/"
+
+FFMPEG_DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+\.\d+)")
+FFMPEG_TIME = re.compile(r"time=(\d+):(\d+):(\d+\.\d+)")
+
+
+def _seconds(match: re.Match | None) -> float:
+    if not match:
+        return 0.0
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def normalize_audio(file_content: bytes) -> tuple[bytes, str]:
+    """Downmix, resample, trim silence and re-encode audio, returns audio and its file name"""
+    ffmpeg = shutil.which("ffmpeg")
+    if not NORMALIZE_AUDIO or not ffmpeg:
+        if NORMALIZE_AUDIO:
+            log.warning("ffmpeg not found, sending audio without normalization")
+        return file_content, "audio.mp3"
+
+    # a single streaming pass, the track is never buffered whole (as areverse would):
+    # leading silence is trimmed, any later silence is cut down to about a second
+    trim = (
+        f"silenceremove=start_periods=1:start_threshold={SILENCE_THRESHOLD}:start_silence=0.5"
+        f":stop_periods=-1:stop_threshold={SILENCE_THRESHOLD}:stop_duration=1:stop_silence=0.5"
+    )
+    filters = ",".join(["aformat=channel_layouts=mono", "aresample=16000", trim])
+
+    # input from a file, so ffmpeg can report its duration
+    with tempfile.NamedTemporaryFile() as source:
+        source.write(file_content)
+        source.flush()
+
+        command = [ffmpeg, "-hide_banner", "-i", source.name, "-vn", "-af", filters]
+        command += ["-c:a", "libopus", "-b:a", NORMALIZED_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1"]
+        try:
+            result = subprocess.run(command, capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            log.error(f"Error normalizing audio: {e.stderr.decode('utf-8', 'replace')[-500:]}")
+            return file_content, "audio.mp3"
+
+    stderr = result.stderr.decode("utf-8", "replace")
+    duration = _seconds(FFMPEG_DURATION.search(stderr))
+    # ffmpeg reports progress repeatedly, the last one is the output length
+    progress = list(FFMPEG_TIME.finditer(stderr))
+    normalized_duration = _seconds(progress[-1] if progress else None)
+
+    if not result.stdout or len(result.stdout) >= len(file_content):
+        log.info(f"Normalized audio is not smaller ({len(result.stdout)} B), sending original")
+        return file_content, "audio.mp3"
+
+    log.info(
+        f"Normalized audio: {len(file_content)} B -> {len(result.stdout)} B "
+        f"({100 * (1 - len(result.stdout) / len(file_content)):.0f}% smaller), "
+        f"{duration:.1f} s -> {normalized_duration:.1f} s of audio"
+    )
+    return result.stdout, "audio.ogg"
+
+
+def transcribe_audio(file_content: bytes, file_name: str = "audio.mp3") -> list[str]:
+    # pass bytes instead of an open file so retries can resend the whole audio
+    transcription = scheduler.call(
+        openai_aclient.audio.transcriptions.create,
+        priority=BULK,
+        model="whisper-1",
+        file=(file_name, file_content),
+    )
 
     return transcription.text
 
@@ -57,7 +133,7 @@ def _main():
 
     if args.audio:
         with open(args.audio, "rb") as audio_file:
-            transcription = transcribe_audio(audio_file.read())
+            transcription = transcribe_audio(*normalize_audio(audio_file.read()))
 
         with open(
             f"{'.'.join(args.audio.split('.')[:-1])}_transcript.txt",
@@ -82,9 +158,17 @@ def on_new_audio(cloud_event):
 
     bucket_name = data["bucket"]
     file_name = data["name"]
+    # custom metadata (tenant_id) is passed on to the transcript
+    metadata = data.get("metadata") or {}
+
+    if file_name.startswith(RECORDINGS_FOLDER):
+        log.info(f"Skipping archived live recording {bucket_name}:{file_name}, it is already transcribed")
+        return
 
     log.info(f"Processing file: {bucket_name}:{file_name}")
     log.info(f"Event ID: {event_id}, Event type: {event_type}")
+    # failed events of this stage are retried with the traffic, see deadletter.py
+    deadletter.replay_due(STAGE)
 
     BUCKET_AUDIO = os.getenv("BUCKET_AUDIO")
     BUCKET_TRANSCRIPTS = os.getenv("BUCKET_TRANSCRIPTS")
@@ -98,31 +182,45 @@ def on_new_audio(cloud_event):
             # Read file from GCS
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(file_name)
-            audio_bytes = blob.download_as_bytes()
+            audio_bytes, digest = cache.download_with_hash(blob)
         except Exception as e:
             log.error(f"Error reading file {file_name}: {e}")
             log.error("File not longer exists")
             return
 
-        try:
-            transcription = transcribe_audio(audio_bytes)
-            log.info(f"Transcription: {transcription[:100]}...")
+        # results of previous failed attempts
+        results = deadletter.intermediate(STAGE, file_name)
 
-        except Exception as e:
-            log.error(f"Error transcribing file {file_name}: {e}")
-            return
-
-        try:
-            bucket_transcripts = storage_client.bucket(BUCKET_TRANSCRIPTS)
-            # save transcription to new file
-            new_blob = bucket_transcripts.blob(f"{file_name}.txt")
-            new_blob.upload_from_string(transcription)
-        except Exception as e:
-            log.error(f"Error saving transcription to bucket {BUCKET_TRANSCRIPTS}: {e}")
-            log.error(f"{file_name}: {e}")
-            return
+        # same audio transcribed before, the cached transcript goes straight to the transcripts bucket
+        cached = not results and cache.copy_cached(
+            cache.TRANSCRIPTS, digest, BUCKET_TRANSCRIPTS, f"{file_name}.txt", metadata
+        )
+        if not cached:
+            try:
+                transcription = results.get("transcription") or transcribe_audio(*normalize_audio(audio_bytes))
+                log.info(f"Transcription: {transcription[:100]}...")
+
+            except Exception as e:
+                log.error(f"Error transcribing file {file_name}: {e}")
+                deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id)
+                return
+
+            try:
+                bucket_transcripts = storage_client.bucket(BUCKET_TRANSCRIPTS)
+                # save transcription to new file
+                new_blob = bucket_transcripts.blob(f"{file_name}.txt")
+                new_blob.metadata = metadata or None
+                new_blob.upload_from_string(transcription)
+            except Exception as e:
+                log.error(f"Error saving transcription to bucket {BUCKET_TRANSCRIPTS}: {e}")
+                log.error(f"{file_name}: {e}")
+                deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id, {"transcription": transcription})
+                return
+
+            cache.store(cache.TRANSCRIPTS, digest, transcription)
 
         log.info(f"Transcription saved to {BUCKET_TRANSCRIPTS}/{file_name}.txt")
+        deadletter.resolve(STAGE, file_name)
 
     else:
         log.warning(f"File {file_name} is not an audio file")
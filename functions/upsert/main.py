@@ -1,6 +1,16 @@
 import functions_framework
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, UpdateResult
+from qdrant_client.models import (
+    PointStruct,
+    UpdateResult,
+    Record,
+    Filter,
+    FieldCondition,
+    MatchAny,
+    MatchValue,
+    IsEmptyCondition,
+    PayloadField,
+)
 from dotenv import load_dotenv
 from google.cloud import storage, secretmanager
 import os
@@ -8,7 +18,11 @@ import logging
 import json
 from pydantic import BaseModel
 import time
+import uuid
 from datetime import datetime
+import deadletter
+import minhash
+import numpy as np
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -27,12 +41,22 @@ load_dotenv()
 QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT", None)
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
 QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "test")
+# answered questions of shards (FAQ_ANSWERS in functions/analyze), created by `utils/qdrant.py --create`
+QDRANT_FAQ_COLLECTION = os.getenv("QDRANT_FAQ_COLLECTION", f"{QDRANT_COLLECTION}_faq")
 VECTOR_SIZE = int(os.getenv("VECTOR_SIZE"))
+# two-stage search collection (utils/vector_backend.py): named vectors "full" and "prefix"
+MATRYOSHKA_DIM = int(os.getenv("MATRYOSHKA_DIM", 0))
 
 assert QDRANT_ENDPOINT, "QDRANT_ENDPOINT environment variable is not set"
 assert QDRANT_API_KEY, "QDRANT_API_KEY environment variable is not set"
 assert VECTOR_SIZE, "VECTOR_SIZE environment variable is not set"
 
+# near-duplicate shards are merged into the existing point instead of upserted
+DEDUPE = os.getenv("DEDUPE", "1") == "1"
+DEDUPE_JACCARD = float(os.getenv("DEDUPE_JACCARD", 0.8))
+DEDUPE_SIMILARITY = float(os.getenv("DEDUPE_SIMILARITY", 0.97))
+DEDUPE_CANDIDATES = 20
+
 BUCKET_PROCESSED = os.getenv("BUCKET_PROCESSED")
 assert BUCKET_PROCESSED, "BUCKET_PROCESSED environment variable is not set"
 
@@ -42,16 +66,31 @@ client = QdrantClient(url=f"{QDRANT_ENDPOINT}:6333", api_key=QDRANT_API_KEY)
 # Initialize Google Cloud Storage client
 storage_client = storage.Client()
 
+# name of this pipeline stage in dead-letter records
+STAGE = "upsert"
+
 
 class AnalysisModel(BaseModel):
     phrases: list[str]
     keypoints: list[str]
+    language: str = ""
+
+
+class FaqModel(BaseModel):
+    question: str
+    answer: str
+    embeddings: list[float]
 
 
 class KnowledgeModel(BaseModel):
     information: str
     analysis: AnalysisModel
     embeddings: list[float]
+    source: str = ""
+    media_type: str = "text"
+    chunk_index: int = 0
+    tenant_id: str = ""
+    faq: list[FaqModel] = []
 
 
 def upsert_points(points: list[PointStruct]) -> UpdateResult:
@@ -64,26 +103,162 @@ def upsert_points(points: list[PointStruct]) -> UpdateResult:
     return result
 
 
-def prepare_points(knowledge: KnowledgeModel) -> list[PointStruct]:
+def analysis_to_text(analysis: AnalysisModel) -> str:
+    # keep in sync with analysis_to_text in functions/analyze/analyze.py
+    return "\n".join(analysis.phrases) + "\n".join(analysis.keypoints)
+
+
+def prepare_payload(knowledge: KnowledgeModel, signature: np.ndarray) -> dict:
+    # keep in sync with PAYLOAD_INDEXES in utils/vector_backend.py
+    payload = {
+        "information_shard": knowledge.information,
+        "source": knowledge.source,
+        "media_type": knowledge.media_type,
+        "chunk_index": knowledge.chunk_index,
+        "ingested_at": int(time.time()),
+        "language": knowledge.analysis.language,
+        "minhash": signature.tolist(),
+        "minhash_bands": minhash.bands(signature),
+        # text the vector is the embedding of, lets utils/migrate.py --reembed re-create it
+        "analysis_text": analysis_to_text(knowledge.analysis),
+    }
+    # points without tenant have no tenant_id, like the ones upserted before tenants existed
+    if knowledge.tenant_id:
+        payload["tenant_id"] = knowledge.tenant_id
+    return payload
+
+
+def prepare_vector(embeddings: list[float]) -> list[float] | dict[str, list[float]]:
+    if not MATRYOSHKA_DIM:
+        return embeddings
+    # keep in sync with prefix_vector in utils/vector_backend.py
+    prefix = np.asarray(embeddings[:MATRYOSHKA_DIM], dtype=np.float32)
+    norm = np.linalg.norm(prefix)
+    return {"full": embeddings, "prefix": (prefix / norm if norm else prefix).tolist()}
+
+
+def prepare_points(knowledge: KnowledgeModel, signature: np.ndarray) -> list[PointStruct]:
     points = [
         PointStruct(
             id=int(time.time() * 1e6),
-            vector=knowledge.embeddings,
-            payload={"information_shard": knowledge.information},
+            vector=prepare_vector(knowledge.embeddings),
+            payload=prepare_payload(knowledge, signature),
         ),
     ]
     return points
 
 
+def prepare_faq_points(knowledge: KnowledgeModel, shard_id: int) -> list[PointStruct]:
+    # same filterable fields as the shard, so FAQ lookups take the same filters as search
+    payload = {
+        "source": knowledge.source,
+        "media_type": knowledge.media_type,
+        "chunk_index": knowledge.chunk_index,
+        "ingested_at": int(time.time()),
+        "language": knowledge.analysis.language,
+        "shard_id": shard_id,
+    }
+    if knowledge.tenant_id:
+        payload["tenant_id"] = knowledge.tenant_id
+
+    return [
+        PointStruct(
+            id=str(uuid.uuid5(uuid.NAMESPACE_OID, f"{shard_id}:{i}")),
+            vector=faq.embeddings,
+            payload={**payload, "question": faq.question, "answer": faq.answer},
+        )
+        for i, faq in enumerate(knowledge.faq)
+    ]
+
+
+def upsert_faq(knowledge: KnowledgeModel, shard_id: int):
+    if not knowledge.faq:
+        return
+    faq_points = prepare_faq_points(knowledge, shard_id)
+    client.upsert(collection_name=QDRANT_FAQ_COLLECTION, points=faq_points, wait=True)
+    log.info(f"Upserted {len(faq_points)} FAQ answers of shard {shard_id}")
+
+
 def get_knowledge(knowledge_str: str) -> KnowledgeModel:
     knowledge_dict = json.loads(knowledge_str)
     return KnowledgeModel(**knowledge_dict)
 
 
-def process_knowledge(knowledge_str: str) -> UpdateResult:
+def tenant_filter(tenant_id: str) -> Filter:
+    if tenant_id:
+        return Filter(must=[FieldCondition(key="tenant_id", match=MatchValue(value=tenant_id))])
+    return Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="tenant_id"))])
+
+
+def find_duplicate(knowledge: KnowledgeModel, signature: np.ndarray) -> Record | None:
+    """Existing point of the same tenant with near-identical text (MinHash/LSH) or near-identical vector"""
+    # shards of other tenants are never merged
+    tenant = tenant_filter(knowledge.tenant_id)
+
+    candidates, _ = client.scroll(
+        collection_name=QDRANT_COLLECTION,
+        scroll_filter=Filter(
+            must=[tenant, FieldCondition(key="minhash_bands", match=MatchAny(any=minhash.bands(signature)))]
+        ),
+        limit=DEDUPE_CANDIDATES,
+        with_payload=["minhash", "source", "duplicate_sources"],
+    )
+    for candidate in candidates:
+        similarity = minhash.similarity(signature, candidate.payload.get("minhash", []))
+        if similarity >= DEDUPE_JACCARD:
+            log.info(f"Shard is a near-duplicate of point {candidate.id} (jaccard {similarity:.2f})")
+            return candidate
+
+    hits = client.query_points(
+        collection_name=QDRANT_COLLECTION,
+        query=knowledge.embeddings,
+        using="full" if MATRYOSHKA_DIM else None,
+        query_filter=tenant,
+        limit=1,
+        score_threshold=DEDUPE_SIMILARITY,
+        with_payload=["source", "duplicate_sources"],
+    ).points
+    if hits:
+        log.info(f"Shard is a near-duplicate of point {hits[0].id} (similarity {hits[0].score:.3f})")
+        return hits[0]
+
+    return None
+
+
+def merge_duplicate(duplicate: Record, knowledge: KnowledgeModel) -> UpdateResult | None:
+    """Remember the source of the skipped shard on the existing point"""
+    sources = duplicate.payload.get("duplicate_sources", [])
+    if knowledge.source in sources or knowledge.source == duplicate.payload.get("source"):
+        return None
+
+    return client.set_payload(
+        collection_name=QDRANT_COLLECTION,
+        payload={"duplicate_sources": sources + [knowledge.source]},
+        points=[duplicate.id],
+        wait=True,
+    )
+
+
+def process_knowledge(knowledge_str: str, tenant_id: str = "") -> UpdateResult | None:
     knowledge = get_knowledge(knowledge_str)
-    points = prepare_points(knowledge)
+    # knowledge files written before tenants were introduced carry it only in metadata
+    knowledge.tenant_id = knowledge.tenant_id or tenant_id
+    signature = minhash.signature(knowledge.information)
+
+    # shards too short to shingle are never treated as duplicates
+    if DEDUPE and len(signature):
+        duplicate = find_duplicate(knowledge, signature)
+        if duplicate:
+            # a replay of a failed FAQ upsert finds the shard written by the first attempt,
+            # FAQ point ids derive from the shard id so writing them again is idempotent
+            if knowledge.faq and duplicate.payload.get("source") == knowledge.source:
+                upsert_faq(knowledge, duplicate.id)
+            return merge_duplicate(duplicate, knowledge)
+
+    points = prepare_points(knowledge, signature)
     result = upsert_points(points)
+    upsert_faq(knowledge, points[0].id)
+
     return result
 
 
@@ -97,9 +272,12 @@ def on_knowledge(cloud_event):
 
     bucket_name = data["bucket"]
     file_name = data["name"]
+    metadata = data.get("metadata") or {}
 
     log.info(f"Processing file: {bucket_name}:{file_name}")
     log.info(f"Event ID: {event_id}, Event type: {event_type}")
+    # failed events of this stage are retried with the traffic, see deadletter.py
+    deadletter.replay_due(STAGE)
 
     if file_name.endswith(".json"):
         try:
@@ -107,8 +285,6 @@ def on_knowledge(cloud_event):
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(file_name)
             knowledge_str = blob.download_as_string().decode("utf-8")
-            result = process_knowledge(knowledge_str)
-            log.info(f"Upsert result: {result}")
 
         except UnicodeDecodeError as e:
             log.error(f"Error decoding file: {e}")
@@ -118,6 +294,17 @@ def on_knowledge(cloud_event):
             log.error(f"Error reading file {file_name}: {e}")
             log.error("File not longer exists")
             return
+
+        try:
+            result = process_knowledge(knowledge_str, metadata.get("tenant_id", ""))
+            log.info(f"Upsert result: {result}")
+
+        except Exception as e:
+            log.error(f"Error upserting knowledge {file_name}: {e}")
+            deadletter.record_failure(STAGE, bucket_name, file_name, e, event_id)
+            return
+
+        deadletter.resolve(STAGE, file_name)
     else:
         log.error(f"File {file_name} is not a knowledge file")
 
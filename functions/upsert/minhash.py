@@ -0,0 +1,55 @@
+"""MinHash signatures and LSH bands of shard text for near-duplicate detection.
+
+Two shards sharing at least one band are candidates, the fraction of equal signature
+values estimates their Jaccard similarity over word shingles.
+"""
+
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+NUM_PERM = 128
+BANDS = 16  # 16 bands of 8 rows, candidates from ~0.7 Jaccard similarity
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+SEED = 206
+
+# universal hashing (a * x + b) mod p, p < 2^31 so products fit into uint64
+PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(SEED)
+_A = _rng.integers(1, int(PRIME), NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, int(PRIME), NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str) -> set[str]:
+    words = re.findall(r"\w+", text.lower())
+    # too short to shingle, such texts are not compared at all
+    if len(words) < SHINGLE_WORDS:
+        return set()
+    return {" ".join(words[i : i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def signature(text: str) -> np.ndarray:
+    """MinHash signature, empty for texts without shingles"""
+    hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)], dtype=np.uint64)
+    if not len(hashes):
+        return np.zeros(0, dtype=np.uint64)
+    hashes %= PRIME
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % PRIME).min(axis=1)
+
+
+def bands(sig: np.ndarray) -> list[str]:
+    if not len(sig):
+        return []
+    return [
+        f"{band}:{hashlib.md5(sig[band * ROWS : (band + 1) * ROWS].tobytes()).hexdigest()[:16]}" for band in range(BANDS)
+    ]
+
+
+def similarity(sig: np.ndarray, other: np.ndarray | list[int]) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    if not len(sig) or len(sig) != len(other):
+        return 0.0
+    return float(np.mean(sig == np.asarray(other, dtype=np.uint64)))
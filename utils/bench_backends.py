@@ -0,0 +1,130 @@
+"""Search latency of the local (flat and IVF) and Qdrant vector backends.
+
+Uses synthetic clustered unit vectors, queries are noisy copies of indexed vectors.
+Recall is measured against the exact (flat) top-k, memory is the size of the vectors
+a search scans and so has to keep in RAM (full vectors, or prefixes for two-stage):
+
+    python utils/bench_backends.py --vectors 20000
+    python utils/bench_backends.py --vectors 20000 --qdrant   # needs QDRANT_ENDPOINT/QDRANT_API_KEY
+    python utils/bench_backends.py --vectors 100000 --prefix-dim 128
+
+With --prefix-dim the variance of the synthetic vectors decays along the dimensions, like
+in Matryoshka embeddings (text-embedding-3), and two-stage search (MATRYOSHKA_DIM) is
+compared with single-stage search of the same backend.
+"""
+
+from qdrant_client.models import PointStruct
+from vector_backend import LocalBackend, QdrantBackend
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+load_dotenv()
+
+BATCH = 1000
+
+
+def clustered_vectors(n: int, dim: int, clusters: int, rng: np.random.Generator, decay: int = 0) -> np.ndarray:
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim))
+    if decay:
+        # leading dimensions carry most of the information
+        vectors *= 1 / (1 + np.arange(dim) / decay)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+async def fill(backend, vectors: np.ndarray):
+    for start in range(0, len(vectors), BATCH):
+        await backend.upsert(
+            [
+                PointStruct(id=start + i, vector=vector.tolist(), payload={"chunk_index": start + i})
+                for i, vector in enumerate(vectors[start : start + BATCH])
+            ]
+        )
+
+
+async def measure(backend, queries: np.ndarray, limit: int) -> tuple[list[float], list[set]]:
+    latencies, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        points = await backend.search(query.tolist(), limit=limit)
+        latencies.append(time.perf_counter() - started)
+        results.append({point.id for point in points})
+    return latencies, results
+
+
+def report(name: str, latencies: list[float], results: list[set], exact: list[set], memory: int):
+    recall = np.mean([len(found & truth) / len(truth) for found, truth in zip(results, exact)])
+    latencies_ms = np.array(latencies) * 1000
+    print(
+        f"{name:18} p50: {np.percentile(latencies_ms, 50):7.2f} ms  p99: {np.percentile(latencies_ms, 99):7.2f} ms  "
+        f"qps: {len(latencies) / sum(latencies):8.1f}  recall: {recall:.3f}  memory: {memory / 2**20:7.1f} MiB"
+    )
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    vectors = clustered_vectors(args.vectors, args.dim, args.clusters, rng, decay=args.prefix_dim)
+    noise = rng.normal(size=(args.queries, args.dim)) / (1 + np.arange(args.dim) / (args.prefix_dim or np.inf))
+    queries = vectors[rng.integers(0, len(vectors), args.queries)] + 0.05 * noise
+    print(f"{args.vectors} vectors x {args.dim} dims ({vectors.nbytes / 2**20:.1f} MiB), {args.queries} queries")
+    full_memory = vectors.nbytes
+    prefix_memory = args.vectors * args.prefix_dim * 4
+
+    with tempfile.TemporaryDirectory() as path:
+        local = LocalBackend(path, args.dim, nprobe=args.nprobe)
+        await fill(local, vectors)
+
+        latencies, exact = await measure(local, queries, args.limit)
+        report("local flat", latencies, exact, exact, full_memory)
+
+        if args.prefix_dim:
+            two_stage = LocalBackend(path, args.dim, prefix_dim=args.prefix_dim)
+            latencies, results = await measure(two_stage, queries, args.limit)
+            report(f"local 2-stage/{args.prefix_dim}", latencies, results, exact, prefix_memory)
+
+        local.build_ivf(args.ivf_lists or int(np.sqrt(args.vectors)))
+        latencies, results = await measure(local, queries, args.limit)
+        report(f"local ivf/{args.nprobe}", latencies, results, exact, full_memory)
+
+    if args.qdrant:
+        from qdrant_client import AsyncQdrantClient
+
+        client = AsyncQdrantClient(url=f"{os.getenv('QDRANT_ENDPOINT')}:6333", api_key=os.getenv("QDRANT_API_KEY"))
+        backends = [("qdrant", QdrantBackend(client, f"bench_{int(time.time())}", args.dim), full_memory)]
+        if args.prefix_dim:
+            collection = f"bench_{int(time.time())}_prefix"
+            backends.append(
+                (
+                    f"qdrant 2-stage/{args.prefix_dim}",
+                    QdrantBackend(client, collection, args.dim, prefix_dim=args.prefix_dim),
+                    prefix_memory,
+                )
+            )
+        for name, qdrant, memory in backends:
+            await qdrant.create()
+            try:
+                await fill(qdrant, vectors)
+                latencies, results = await measure(qdrant, queries, args.limit)
+                report(name, latencies, results, exact, memory)
+            finally:
+                await qdrant.delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vector backends")
+    parser.add_argument("--vectors", type=int, default=20_000, help="Number of indexed vectors")
+    parser.add_argument("--dim", type=int, default=int(os.getenv("VECTOR_SIZE", 768)), help="Vector size")
+    parser.add_argument("--clusters", type=int, default=100, help="Clusters of the synthetic data")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--limit", type=int, default=5, help="Top-k")
+    parser.add_argument("--ivf-lists", type=int, help="IVF lists, sqrt(vectors) by default")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF lists searched per query")
+    parser.add_argument("--qdrant", action="store_true", help="Also benchmark the Qdrant backend")
+    parser.add_argument("--prefix-dim", type=int, default=0, help="Also benchmark two-stage search with this prefix")
+    asyncio.run(main(parser.parse_args()))
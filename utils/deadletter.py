@@ -0,0 +1,113 @@
+"""Inspect and replay dead-letter records of the pipeline functions.
+
+Failed events are recorded by the functions in BUCKET_DEADLETTER as `<stage>/<object name>.json`.
+Replaying re-uploads the source object under the same name, which fires the storage trigger
+again; the function then reuses the intermediate results saved with the record.
+
+The functions replay due records of their own stage whenever they are triggered
+(DEADLETTER_REPLAY_ON_TRIGGER per event). Run `--replay` periodically (cron, Cloud Scheduler)
+as well, so failed events of stages without further traffic are retried with backoff:
+
+    python utils/deadletter.py --list
+    python utils/deadletter.py --replay --stage transcript
+    python utils/deadletter.py --replay --force --include-dead
+"""
+
+from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+
+load_dotenv()
+BUCKET_DEADLETTER = os.getenv("BUCKET_DEADLETTER")
+assert BUCKET_DEADLETTER, "BUCKET_DEADLETTER environment variable is not set"
+
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", 8))
+
+storage_client = storage.Client()
+
+
+def list_records(stage: str | None = None) -> list[dict]:
+    prefix = f"{stage}/" if stage else None
+    records = []
+    for blob in storage_client.list_blobs(BUCKET_DEADLETTER, prefix=prefix):
+        record = json.loads(blob.download_as_text())
+        record["record"] = blob.name
+        records.append(record)
+    return records
+
+
+def is_due(record: dict, force: bool = False, include_dead: bool = False) -> bool:
+    if record["status"] == "dead" and not include_dead:
+        return False
+    return force or datetime.fromisoformat(record["next_attempt_at"]) <= datetime.now(timezone.utc)
+
+
+def drop(record: dict):
+    storage_client.bucket(BUCKET_DEADLETTER).blob(record["record"]).delete()
+    log.info(f"Dropped record {record['record']}")
+
+
+def replay(record: dict) -> bool:
+    bucket = storage_client.bucket(record["bucket"])
+    source = bucket.get_blob(record["name"])
+    if source is None:
+        log.warning(f"Source {record['bucket']}:{record['name']} no longer exists")
+        drop(record)
+        return False
+
+    # new generation of the object fires the finalize trigger of the stage again
+    data = source.download_as_bytes()
+    blob = bucket.blob(record["name"])
+    blob.metadata = source.metadata
+    blob.upload_from_string(data, content_type=source.content_type)
+    log.info(f"Replayed {record['stage']}:{record['name']} (attempts: {record['attempts']})")
+    return True
+
+
+def replay_all(records: list[dict]) -> int:
+    with ThreadPoolExecutor(max_workers=REPLAY_CONCURRENCY) as executor:
+        results = list(executor.map(replay, records))
+    return sum(results)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Dead-letter records of failed pipeline events")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-l", "--list", action="store_true", help="List dead-letter records")
+    group.add_argument("-r", "--replay", action="store_true", help="Replay records which are due")
+    group.add_argument("--drop", action="store_true", help="Delete records (of --stage) without replaying")
+    parser.add_argument("--stage", choices=["transcript", "document", "analyze", "upsert"], help="Only this stage")
+    parser.add_argument("--force", action="store_true", help="Ignore backoff of the records")
+    parser.add_argument("--include-dead", action="store_true", help="Include records which reached max attempts")
+    args = parser.parse_args()
+
+    records = list_records(args.stage)
+
+    if args.list:
+        for record in records:
+            print(
+                f"{record['status']:6} {record['stage']:10} {record['bucket']}:{record['name']} "
+                f"attempts: {record['attempts']} next: {record['next_attempt_at']} "
+                f"saved: {list(record.get('intermediate', {}))} error: {record['error']}"
+            )
+        print(f"{len(records)} records")
+    elif args.replay:
+        due = [record for record in records if is_due(record, args.force, args.include_dead)]
+        replayed = replay_all(due)
+        print(f"Replayed {replayed}/{len(due)} due records ({len(records)} total)")
+    elif args.drop:
+        for record in records:
+            drop(record)
+        print(f"Dropped {len(records)} records")
+    else:
+        parser.print_help()
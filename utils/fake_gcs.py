@@ -0,0 +1,165 @@
+"""Local fake of the Google Cloud Storage upload API.
+
+google-cloud-storage talks to it when STORAGE_EMULATOR_HOST is set:
+
+    python utils/fake_gcs.py --port 9023
+    STORAGE_EMULATOR_HOST=http://127.0.0.1:9023 uvicorn app.main:app
+
+Multipart and resumable uploads are accepted, objects are kept as metadata only
+(size, checksums) so long load tests do not grow the memory of the fake.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import google_crc32c
+
+UPLOAD_PATH = re.compile(r"^/upload/storage/v1/b/([^/]+)/o$")
+CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+
+class Upload:
+    def __init__(self, bucket: str, metadata: dict):
+        self.bucket = bucket
+        self.metadata = metadata
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.crc32c = google_crc32c.Checksum()
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        self.md5.update(data)
+        self.crc32c.update(data)
+
+    def resource(self) -> dict:
+        return {
+            "kind": "storage#object",
+            "id": f"{self.bucket}/{self.metadata['name']}/1",
+            "bucket": self.bucket,
+            "name": self.metadata["name"],
+            "generation": "1",
+            "metageneration": "1",
+            "size": str(self.size),
+            "contentType": self.metadata.get("contentType", "application/octet-stream"),
+            "metadata": self.metadata.get("metadata", {}),
+            "md5Hash": base64.b64encode(self.md5.digest()).decode("ascii"),
+            "crc32c": base64.b64encode(self.crc32c.digest()).decode("ascii"),
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }
+
+
+class StorageHandler(BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    objects = {}  # (bucket, name) -> object resource
+    uploads = {}  # upload id -> Upload in progress
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict | None = None, headers: dict | None = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("content-length", 0)))
+
+    def _store(self, upload: Upload):
+        resource = upload.resource()
+        with self.lock:
+            self.objects[(upload.bucket, resource["name"])] = resource
+        self._send(200, resource)
+
+    def _multipart(self, bucket: str, query: dict):
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers["content-type"]).group(1).encode()
+        parts = [part for part in self._body().split(b"--" + boundary) if part not in (b"", b"--", b"--\r\n")]
+        # first part is the JSON metadata, second the content
+        metadata, content = (part.split(b"\r\n\r\n", 1)[1].removesuffix(b"\r\n") for part in parts[:2])
+        metadata = json.loads(metadata)
+        metadata.setdefault("name", query.get("name", [""])[0])
+
+        upload = Upload(bucket, metadata)
+        upload.write(content)
+        self._store(upload)
+
+    def _start_resumable(self, bucket: str, query: dict):
+        metadata = json.loads(self._body() or b"{}")
+        metadata.setdefault("name", query.get("name", [""])[0])
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = Upload(bucket, metadata)
+
+        host = self.headers.get("host")
+        location = f"http://{host}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}"
+        self._send(200, {}, {"location": location})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        match = UPLOAD_PATH.match(url.path)
+        if not match:
+            self._send(404, {"error": {"code": 404, "message": f"Unknown path {url.path}"}})
+        elif query.get("uploadType") == ["multipart"]:
+            self._multipart(match.group(1), query)
+        elif query.get("uploadType") == ["resumable"]:
+            self._start_resumable(match.group(1), query)
+        else:
+            self._send(400, {"error": {"code": 400, "message": f"Unsupported upload {url.query}"}})
+
+    def do_PUT(self):
+        upload_id = parse_qs(urlparse(self.path).query).get("upload_id", [""])[0]
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+        if upload is None:
+            self._send(404, {"error": {"code": 404, "message": f"Unknown upload {upload_id}"}})
+            return
+
+        data = self._body()
+        start, _, total = CONTENT_RANGE.match(self.headers.get("content-range", "bytes */*")).groups()
+        if start is not None:
+            if int(start) != upload.size:
+                self._send(400, {"error": {"code": 400, "message": f"Expected offset {upload.size}, got {start}"}})
+                return
+            upload.write(data)
+
+        if total != "*" and upload.size == int(total):
+            with self.lock:
+                self.uploads.pop(upload_id, None)
+            self._store(upload)
+        else:
+            # 308 tells the client which bytes were persisted so far
+            self._send(308, None, {"range": f"bytes=0-{upload.size - 1}"} if upload.size else {})
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(port: int = 0) -> ThreadingHTTPServer:
+    server = FakeServer(("127.0.0.1", port), StorageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Google Cloud Storage upload API")
+    parser.add_argument("--port", type=int, default=9023, help="Port of the fake server")
+    args = parser.parse_args()
+
+    server = serve(args.port)
+    print(f"Fake GCS listening, export STORAGE_EMULATOR_HOST=http://127.0.0.1:{server.server_address[1]}")
+    threading.Event().wait()
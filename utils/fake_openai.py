@@ -0,0 +1,199 @@
+"""Local fake of the OpenAI API enforcing per-model rate limits.
+
+Used to check the scheduler behaviour without spending real quota:
+
+    python utils/fake_openai.py --rpm 120 --bulk 60 --interactive 10
+
+Starts the fake server, fires bulk and interactive embedding requests through the
+scheduler and reports 429s seen by the server, failed requests and latency per lane.
+utils/test_scheduler.py runs the same check under pytest.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    rpm = 60
+    lock = threading.Lock()
+    buckets = {}  # model -> (level, last update), replenished continuously like the real API
+    rejected = 0
+    accepted = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict, headers: dict | None = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _admit(self, model: str) -> float:
+        """Return 0 if request is within limits, otherwise seconds until it would be"""
+        cls = RateLimitedHandler
+        now = time.monotonic()
+        rate = cls.rpm / 60
+        with cls.lock:
+            level, updated = cls.buckets.get(model, (cls.rpm, now))
+            level = min(cls.rpm, level + (now - updated) * rate)
+            if level < 1:
+                cls.buckets[model] = (level, now)
+                cls.rejected += 1
+                return (1 - level) / rate
+            cls.buckets[model] = (level - 1, now)
+            cls.accepted += 1
+            return 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+        model = body.get("model", "")
+
+        retry_after = self._admit(model)
+        if retry_after:
+            self._send(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                {"retry-after": f"{retry_after:.2f}"},
+            )
+            return
+
+        if self.path.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            dimensions = body.get("dimensions", 8)
+            self._send(
+                200,
+                {
+                    "object": "list",
+                    "model": model,
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": [1.0 / dimensions] * dimensions}
+                        for i in range(len(inputs))
+                    ],
+                    "usage": {"prompt_tokens": 1, "total_tokens": 1},
+                },
+            )
+        elif self.path.endswith("/responses"):
+            self._send(
+                200,
+                {
+                    "id": "resp_fake",
+                    "object": "response",
+                    "created_at": int(time.time()),
+                    "model": model,
+                    "status": "completed",
+                    "parallel_tool_calls": False,
+                    "tool_choice": "auto",
+                    "tools": [],
+                    "output": [
+                        {
+                            "type": "message",
+                            "id": "msg_fake",
+                            "role": "assistant",
+                            "status": "completed",
+                            "content": [{"type": "output_text", "text": "fake response", "annotations": []}],
+                        }
+                    ],
+                    "usage": {"input_tokens": 1, "output_tokens": 1, "total_tokens": 2},
+                },
+            )
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # bursts of hundreds of connections must not be refused before reaching the limiter
+    request_queue_size = 1024
+
+
+def serve(rpm: int, port: int = 0) -> ThreadingHTTPServer:
+    RateLimitedHandler.rpm = rpm
+    server = FakeServer(("127.0.0.1", port), RateLimitedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def drive(port: int, bulk: int, interactive: int, delay: float, scheduler=None) -> tuple[dict, dict]:
+    """Latencies and failed requests per lane"""
+    import openai
+    from scheduler import INTERACTIVE, BULK
+
+    if scheduler is None:
+        from scheduler import scheduler
+
+    client = openai.AsyncOpenAI(api_key="fake", base_url=f"http://127.0.0.1:{port}/v1", max_retries=0)
+    latencies = {INTERACTIVE: [], BULK: []}
+    failures = {INTERACTIVE: 0, BULK: 0}
+
+    async def request(priority: int, start_after: float):
+        await asyncio.sleep(start_after)
+        started = time.monotonic()
+        try:
+            await scheduler.acall(
+                client.embeddings.create,
+                priority=priority,
+                model="text-embedding-3-small",
+                input="test",
+                dimensions=8,
+            )
+            latencies[priority].append(time.monotonic() - started)
+        except Exception as e:
+            print(f"Request failed: {e}")
+            failures[priority] += 1
+
+    # interactive requests arrive while the bulk backlog is queued
+    await asyncio.gather(
+        *[request(BULK, 0) for _ in range(bulk)],
+        *[request(INTERACTIVE, delay) for _ in range(interactive)],
+    )
+    return latencies, failures
+
+
+def report(latencies: dict, failures: dict):
+    from scheduler import INTERACTIVE, BULK
+
+    for name, lane in (("interactive", INTERACTIVE), ("bulk", BULK)):
+        print(
+            f"{name:12} done: {len(latencies[lane]):4}  failed: {failures[lane]:3}  "
+            f"p50: {percentile(latencies[lane], 0.5):6.2f}s  p99: {percentile(latencies[lane], 0.99):6.2f}s"
+        )
+    print(f"server accepted: {RateLimitedHandler.accepted}  rejected (429): {RateLimitedHandler.rejected}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake rate limited OpenAI server and scheduler check")
+    parser.add_argument("--rpm", type=int, default=120, help="Requests per minute enforced by the server")
+    parser.add_argument("--scheduler-rpm", type=int, help="Requests per minute configured in the scheduler")
+    parser.add_argument("--bulk", type=int, default=60, help="Number of bulk requests")
+    parser.add_argument("--interactive", type=int, default=10, help="Number of interactive requests")
+    parser.add_argument("--delay", type=float, default=1.0, help="Seconds before interactive requests arrive")
+    parser.add_argument("--serve", action="store_true", help="Only run the fake server")
+    parser.add_argument("--port", type=int, default=0, help="Port of the fake server")
+    args = parser.parse_args()
+
+    server = serve(args.rpm, args.port)
+    port = server.server_address[1]
+
+    if args.serve:
+        print(f"Fake OpenAI API listening on http://127.0.0.1:{port}/v1")
+        threading.Event().wait()
+
+    # a scheduler configured above the server limit exercises the 429 retry path
+    os.environ["RATE_LIMIT_TEXT_EMBEDDING_3_SMALL"] = f"{args.scheduler_rpm or args.rpm},0"
+    report(*asyncio.run(drive(port, args.bulk, args.interactive, args.delay)))
+    server.shutdown()
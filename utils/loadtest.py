@@ -0,0 +1,179 @@
+"""Load test of the FastAPI upload endpoints.
+
+Starts the fake GCS (utils/fake_gcs.py) and the app under uvicorn in a subprocess,
+then uploads the sample files at increasing concurrency:
+
+    python utils/loadtest.py --concurrency 1 4 16 64 --requests 200
+    python utils/loadtest.py --long-recording   # adds a >8 MiB file, uploaded resumably
+
+Audio samples (samples/*.mp3) go to /upload/audio, transcripts (samples/*.txt) to
+/upload/document. Reports throughput, latency percentiles, errors and the peak RSS of
+the app process per concurrency level. Peak RSS is read from VmHWM in /proc, which is
+reset between levels.
+"""
+
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import glob
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from fake_gcs import serve, StorageHandler
+
+load_dotenv()
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def proc_status(pid: int, field: str) -> int:
+    """Memory field of /proc/<pid>/status in KiB"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak_rss(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def load_samples(long_recording: bool) -> list[tuple[str, str, bytes]]:
+    """(endpoint, file name, content) of every upload"""
+    samples = []
+    for path in sorted(glob.glob(os.path.join(REPO_ROOT, "samples", "*.mp3"))):
+        with open(path, "rb") as f:
+            samples.append(("/upload/audio", os.path.basename(path), f.read()))
+    for path in sorted(glob.glob(os.path.join(REPO_ROOT, "samples", "*.txt"))):
+        with open(path, "rb") as f:
+            samples.append(("/upload/document", os.path.basename(path), f.read()))
+
+    if long_recording:
+        # MP3 frames concatenate into a valid file, large enough for a resumable upload
+        audio = max((sample for sample in samples if sample[0] == "/upload/audio"), key=lambda sample: len(sample[2]))
+        samples.append(("/upload/audio", f"long_{audio[1]}", audio[2] * 4))
+
+    assert samples, "No samples found in samples/"
+    return samples
+
+
+def start_app(port: int, storage_host: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        STORAGE_EMULATOR_HOST=storage_host,
+        GOOGLE_CLOUD_PROJECT="loadtest",
+        BUCKET_NAME="loadtest-audio",
+        BUCKET_TRANSCRIPTS="loadtest-transcripts",
+        OPENAI_API_KEY="sk-loadtest",
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT,
+        env=env,
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return app
+        except httpx.TransportError:
+            assert app.poll() is None, "App exited during startup"
+            time.sleep(0.2)
+
+    app.terminate()
+    raise TimeoutError("App did not start within 30s")
+
+
+async def run_level(base_url: str, samples: list, concurrency: int, requests: int) -> tuple[list[float], int, float]:
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            endpoint, file_name, content = samples[i % len(samples)]
+            # unique names, the app stages uploads under app/static/<file name>
+            files = {"file": (f"load_{concurrency}_{i}_{file_name}", content)}
+            started = time.perf_counter()
+            try:
+                response = await client.post(endpoint, files=files)
+                if response.status_code >= 400:
+                    errors += 1
+                    print(f"{endpoint} returned {response.status_code}: {response.text[:200]}")
+                else:
+                    latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError as e:
+                errors += 1
+                print(f"{endpoint} failed: {e!r}")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    return latencies, errors, elapsed
+
+
+def main(args):
+    storage = serve()
+    storage_host = f"http://127.0.0.1:{storage.server_address[1]}"
+    port = free_port()
+    samples = load_samples(args.long_recording)
+    total_mib = sum(len(sample[2]) for sample in samples) / 2**20
+    print(f"{len(samples)} sample files ({total_mib:.1f} MiB), {args.requests} requests per level")
+
+    app = start_app(port, storage_host)
+    try:
+        print(f"app RSS after start: {proc_status(app.pid, 'VmRSS') / 1024:.1f} MiB")
+        for concurrency in args.concurrency:
+            if not reset_peak_rss(app.pid):
+                print("Cannot reset peak RSS, values are peaks since start")
+            latencies, errors, elapsed = asyncio.run(
+                run_level(f"http://127.0.0.1:{port}", samples, concurrency, args.requests)
+            )
+            print(
+                f"concurrency {concurrency:4}  {len(latencies) / elapsed:7.1f} req/s  "
+                f"p50: {percentile(latencies, 0.5) * 1000:8.1f} ms  p99: {percentile(latencies, 0.99) * 1000:8.1f} ms  "
+                f"errors: {errors:3}  peak RSS: {proc_status(app.pid, 'VmHWM') / 1024:7.1f} MiB"
+            )
+        print(f"objects stored in fake GCS: {len(StorageHandler.objects)}")
+    finally:
+        app.terminate()
+        app.wait()
+        storage.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the upload endpoints")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="Concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Uploads per concurrency level")
+    parser.add_argument("--long-recording", action="store_true", help="Add a >8 MiB recording (resumable upload)")
+    main(parser.parse_args())
@@ -0,0 +1,334 @@
+"""Export, import and re-embed Qdrant collections.
+
+Points are streamed page by page, so collections larger than memory can be moved.
+A snapshot is a gzipped JSONL file: a header line with the collection config, then one
+line per point with the payload and base64 encoded float32 vectors.
+
+    python utils/migrate.py export backup.jsonl.gz
+    python utils/migrate.py import backup.jsonl.gz --collection restored
+    python utils/migrate.py migrate --to knowledge_v2 --alias knowledge
+    python utils/migrate.py migrate --to knowledge_v2 --vector-size 1024 --reembed --alias knowledge
+    python utils/migrate.py migrate --to knowledge_v3 --prefix-dim 128 --alias knowledge
+    python utils/migrate.py alias knowledge knowledge_v2
+
+--reembed embeds the same text as the pipeline did: the question of FAQ points and the
+analysis text (phrases and keypoints) of knowledge points, stored in their payload by
+functions/upsert. Points upserted before analysis_text was stored cannot be re-embedded
+consistently and fail the migration, re-ingest their sources instead.
+
+The target collection gets the vector size and prefix size of the snapshot header (import)
+or the source collection (migrate), unless --vector-size or --prefix-dim override them.
+
+Queries should go through an alias (QDRANT_COLLECTION=<alias>), `migrate --alias` fills the
+new collection while the old one keeps serving and then switches the alias atomically.
+Points ingested into the source meanwhile (by their ingested_at) are copied by a catch-up
+pass before the switch and once more after it, for writers still holding the old target.
+Points deleted from the source during the migration are not caught up.
+"""
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    PointStruct,
+    Filter,
+    FieldCondition,
+    Range,
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+)
+from vector_backend import QdrantBackend, FULL, PREFIX
+from scheduler import scheduler, estimate_tokens, BULK
+from dotenv import load_dotenv
+from typing import AsyncIterator
+import numpy as np
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import openai
+import os
+import time
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+
+load_dotenv()
+QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT", None)
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "test")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+MULTITENANT = os.getenv("MULTITENANT", "0") == "1"
+
+assert QDRANT_ENDPOINT, "QDRANT_ENDPOINT environment variable is not set"
+assert QDRANT_API_KEY, "QDRANT_API_KEY environment variable is not set"
+
+PAGE_SIZE = int(os.getenv("MIGRATE_PAGE_SIZE", 256))
+UPSERT_CONCURRENCY = int(os.getenv("MIGRATE_CONCURRENCY", 4))
+# catch-up passes start this many seconds early, clocks of the writers may lag behind
+CATCH_UP_MARGIN = int(os.getenv("MIGRATE_CATCH_UP_MARGIN", 60))
+
+client = AsyncQdrantClient(url=f"{QDRANT_ENDPOINT}:6333", api_key=QDRANT_API_KEY)
+
+
+def encode_vector(vector) -> str | dict[str, str]:
+    if isinstance(vector, dict):
+        return {name: encode_vector(named) for name, named in vector.items()}
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(encoded: str | dict[str, str]) -> list[float] | dict[str, list[float]]:
+    if isinstance(encoded, dict):
+        return {name: decode_vector(named) for name, named in encoded.items()}
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32).tolist()
+
+
+async def scroll_points(collection: str, scroll_filter: Filter | None = None) -> AsyncIterator[list]:
+    """Pages of points including vectors"""
+    offset = None
+    while True:
+        points, offset = await client.scroll(
+            collection_name=collection,
+            scroll_filter=scroll_filter,
+            limit=PAGE_SIZE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if points:
+            yield points
+        if offset is None:
+            break
+
+
+def vectors_config(vectors) -> dict:
+    # two-stage collections have named vectors ("full"/"prefix", see vector_backend.py)
+    if isinstance(vectors, dict):
+        return {name: params.model_dump(mode="json") for name, params in vectors.items()}
+    return vectors.model_dump(mode="json")
+
+
+def layout_from_config(vectors: dict) -> tuple[int, int]:
+    """Vector size and prefix size (0 for single vectors) of a serialized vectors config"""
+    if "size" in vectors:
+        return vectors["size"], 0
+    return vectors[FULL]["size"], vectors[PREFIX]["size"]
+
+
+async def source_layout(collection: str) -> tuple[int, int]:
+    info = await client.get_collection(collection)
+    return layout_from_config(vectors_config(info.config.params.vectors))
+
+
+async def export_collection(collection: str, snapshot: str) -> int:
+    info = await client.get_collection(collection)
+    exported = 0
+    with gzip.open(snapshot, "wt", encoding="utf-8") as f:
+        header = {"collection": collection, "vectors": vectors_config(info.config.params.vectors)}
+        f.write(json.dumps(header) + "\n")
+        async for points in scroll_points(collection):
+            for point in points:
+                f.write(json.dumps({"id": point.id, "payload": point.payload, "vector": encode_vector(point.vector)}) + "\n")
+            exported += len(points)
+            log.info(f"Exported {exported} points")
+    return exported
+
+
+def read_header(snapshot: str) -> dict:
+    with gzip.open(snapshot, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+
+async def read_snapshot(snapshot: str) -> AsyncIterator[list[PointStruct]]:
+    with gzip.open(snapshot, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        log.info(f"Importing snapshot of {header['collection']}")
+        page = []
+        for line in f:
+            record = json.loads(line)
+            page.append(PointStruct(id=record["id"], payload=record["payload"], vector=decode_vector(record["vector"])))
+            if len(page) == PAGE_SIZE:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+async def scroll_as_points(collection: str, scroll_filter: Filter | None = None) -> AsyncIterator[list[PointStruct]]:
+    async for points in scroll_points(collection, scroll_filter):
+        yield [PointStruct(id=point.id, payload=point.payload, vector=point.vector) for point in points]
+
+
+openai_client = None
+
+
+async def reembed(points: list[PointStruct], vector_size: int) -> list[PointStruct]:
+    """Replace vectors with new embeddings of the analysis text (or FAQ question)"""
+    global openai_client
+    if openai_client is None:
+        assert os.getenv("OPENAI_API_KEY"), "OPENAI_API_KEY environment variable is not set"
+        openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+    # FAQ collections embed the question, knowledge collections the analysis of the shard;
+    # embedding the raw shard instead would rank migrated points differently from new ones
+    texts = [point.payload.get("question") or point.payload.get("analysis_text") for point in points]
+    missing = [point.id for point, text in zip(points, texts) if not text]
+    if missing:
+        raise ValueError(f"{len(missing)} points have no analysis_text to re-embed, e.g. {missing[:5]}")
+    response = await scheduler.acall(
+        openai_client.embeddings.create,
+        priority=BULK,
+        estimated_tokens=estimate_tokens(*texts),
+        model=EMBEDDING_MODEL,
+        input=texts,
+        dimensions=vector_size,
+    )
+    embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    return [PointStruct(id=point.id, payload=point.payload, vector=embedding) for point, embedding in zip(points, embeddings)]
+
+
+async def load_points(
+    pages: AsyncIterator[list[PointStruct]],
+    collection: str,
+    vector_size: int,
+    reembed_points: bool = False,
+    prefix_dim: int = 0,
+) -> int:
+    """Upsert pages into the collection with UPSERT_CONCURRENCY batches in flight"""
+    # the backend converts between single and two-stage (prefix) vector layouts
+    backend = QdrantBackend(client, collection, vector_size, multitenant=MULTITENANT, prefix_dim=prefix_dim)
+    await backend.create()
+
+    semaphore = asyncio.Semaphore(UPSERT_CONCURRENCY)
+    tasks = []
+    loaded = 0
+
+    async def upsert(points: list[PointStruct]):
+        nonlocal loaded
+        try:
+            if reembed_points:
+                points = await reembed(points, vector_size)
+            await backend.upsert(points)
+            loaded += len(points)
+            log.info(f"Loaded {loaded} points into {collection}")
+        finally:
+            semaphore.release()
+
+    async for points in pages:
+        # reading stops while UPSERT_CONCURRENCY batches are in flight, memory stays bounded
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(upsert(points)))
+        if failed := next((task for task in tasks if task.done() and task.exception()), None):
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise failed.exception()
+
+    await asyncio.gather(*tasks)
+    return loaded
+
+
+async def catch_up(
+    source: str,
+    target: str,
+    since: int,
+    vector_size: int,
+    reembed_points: bool = False,
+    prefix_dim: int = 0,
+) -> int:
+    """Copy points ingested into the source since the timestamp, upserts of copied points are idempotent"""
+    ingested = Filter(must=[FieldCondition(key="ingested_at", range=Range(gte=since - CATCH_UP_MARGIN))])
+    count = await load_points(scroll_as_points(source, ingested), target, vector_size, reembed_points, prefix_dim)
+    log.info(f"Caught up {count} points ingested into {source} since {since}")
+    return count
+
+
+async def migrate(
+    source: str,
+    target: str,
+    vector_size: int,
+    reembed_points: bool = False,
+    prefix_dim: int = 0,
+    alias: str | None = None,
+) -> int:
+    """Copy the source into the target, switch the alias and catch up on points ingested meanwhile"""
+    started = int(time.time())
+    await load_points(scroll_as_points(source), target, vector_size, reembed_points, prefix_dim)
+
+    caught_up = int(time.time())
+    await catch_up(source, target, started, vector_size, reembed_points, prefix_dim)
+    if alias:
+        await switch_alias(alias, target)
+        # writers that resolved the alias before the switch may still add points to the source
+        await catch_up(source, target, caught_up, vector_size, reembed_points, prefix_dim)
+    # catch-up passes copy some points twice, count the target instead
+    return (await client.count(collection_name=target, exact=True)).count
+
+
+async def switch_alias(alias: str, collection: str):
+    """Point the alias to the collection in one atomic operation"""
+    operations = []
+    aliases = await client.get_aliases()
+    if any(existing.alias_name == alias for existing in aliases.aliases):
+        operations.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)))
+    operations.append(CreateAliasOperation(create_alias=CreateAlias(collection_name=collection, alias_name=alias)))
+
+    await client.update_collection_aliases(change_aliases_operations=operations)
+    log.info(f"Alias {alias} now points to {collection}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export, import and re-embed Qdrant collections")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Stream a collection into a snapshot file")
+    export_parser.add_argument("snapshot", help="Snapshot file, e.g. backup.jsonl.gz")
+    export_parser.add_argument("--collection", default=QDRANT_COLLECTION, help="Collection or alias to export")
+
+    import_parser = commands.add_parser("import", help="Load a snapshot file into a collection")
+    import_parser.add_argument("snapshot", help="Snapshot file")
+    import_parser.add_argument("--collection", default=QDRANT_COLLECTION, help="Target collection")
+
+    migrate_parser = commands.add_parser("migrate", help="Copy a collection into a new one")
+    migrate_parser.add_argument("--from", dest="source", default=QDRANT_COLLECTION, help="Source collection")
+    migrate_parser.add_argument("--to", required=True, help="Target collection")
+    migrate_parser.add_argument("--alias", help="Switch this alias to the target when done")
+
+    for command in (import_parser, migrate_parser):
+        command.add_argument("--vector-size", type=int, help="Vector size of the target, default of the source")
+        command.add_argument("--reembed", action="store_true", help=f"Re-embed analysis texts with {EMBEDDING_MODEL}")
+        command.add_argument(
+            "--prefix-dim", type=int, help="Prefix vector size of two-stage search, 0 for none, default of the source"
+        )
+
+    alias_parser = commands.add_parser("alias", help="Point an alias to a collection")
+    alias_parser.add_argument("alias", help="Alias name")
+    alias_parser.add_argument("collection", help="Collection name")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        count = asyncio.run(export_collection(args.collection, args.snapshot))
+        print(f"Exported {count} points to {args.snapshot}")
+    elif args.command == "import":
+        vector_size, prefix_dim = layout_from_config(read_header(args.snapshot)["vectors"])
+        vector_size = args.vector_size if args.vector_size is not None else vector_size
+        prefix_dim = args.prefix_dim if args.prefix_dim is not None else prefix_dim
+        count = asyncio.run(
+            load_points(read_snapshot(args.snapshot), args.collection, vector_size, args.reembed, prefix_dim)
+        )
+        print(f"Imported {count} points into {args.collection}")
+    elif args.command == "migrate":
+
+        async def run_migration():
+            vector_size, prefix_dim = await source_layout(args.source)
+            vector_size = args.vector_size if args.vector_size is not None else vector_size
+            prefix_dim = args.prefix_dim if args.prefix_dim is not None else prefix_dim
+            return await migrate(args.source, args.to, vector_size, args.reembed, prefix_dim, args.alias)
+
+        count = asyncio.run(run_migration())
+        print(f"Migrated {count} points from {args.source} to {args.to}")
+    elif args.command == "alias":
+        asyncio.run(switch_alias(args.alias, args.collection))
@@ -0,0 +1,163 @@
+"""Opt-in profiling of the query path of utils/qdrant.py.
+
+Inside `profile_query()` every step of retrieve_and_summarize records its wall-clock time
+(including the wait in the scheduler) and the token usage reported in its OpenAI responses.
+Steps called from other steps are named by their path, e.g. "pack_context > extract".
+Outside of it the hooks only read a context variable. The whole query can also be captured
+by cProfile or pyinstrument (pip install pyinstrument).
+"""
+
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import cProfile
+import functools
+import io
+import pstats
+import time
+
+CAPTURES = ("cprofile", "pyinstrument")
+# functions listed in the cProfile report
+CPROFILE_LINES = 40
+
+
+class QueryProfile:
+    """Timings and token usage of the steps of one query"""
+
+    def __init__(self, capture: str | None = None):
+        assert capture in (None, *CAPTURES), f"Unknown capture {capture}, use one of {CAPTURES}"
+        self.capture = capture
+        self.steps: list[dict] = []
+        self.seconds = 0.0
+        # text report of cProfile or pyinstrument
+        self.report = ""
+
+    def breakdown(self) -> dict:
+        steps = {}
+        for record in self.steps:
+            total = steps.setdefault(
+                record["step"], {"calls": 0, "seconds": 0.0, "input_tokens": 0, "output_tokens": 0}
+            )
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            total["input_tokens"] += record["input_tokens"]
+            total["output_tokens"] += record["output_tokens"]
+
+        return {
+            "seconds": round(self.seconds, 3),
+            "input_tokens": sum(record["input_tokens"] for record in self.steps),
+            "output_tokens": sum(record["output_tokens"] for record in self.steps),
+            "steps": {name: {**total, "seconds": round(total["seconds"], 3)} for name, total in steps.items()},
+        }
+
+    def summary(self) -> str:
+        breakdown = self.breakdown()
+        lines = [f"{'step':32} {'calls':>5} {'seconds':>8} {'share':>6} {'tokens in':>10} {'tokens out':>10}"]
+        for name, total in breakdown["steps"].items():
+            share = total["seconds"] / self.seconds if self.seconds else 0
+            lines.append(
+                f"{name:32} {total['calls']:5} {total['seconds']:8.3f} {share:6.0%} "
+                f"{total['input_tokens']:10} {total['output_tokens']:10}"
+            )
+        lines.append(
+            f"{'total':32} {'':5} {self.seconds:8.3f} {'':6} "
+            f"{breakdown['input_tokens']:10} {breakdown['output_tokens']:10}"
+        )
+        return "\n".join(lines)
+
+
+current: ContextVar[QueryProfile | None] = ContextVar("query_profile", default=None)
+current_step: ContextVar[dict | None] = ContextVar("query_profile_step", default=None)
+
+
+@contextmanager
+def step(name: str):
+    """Record wall-clock time of the block as a step of the running profile"""
+    profile = current.get()
+    if profile is None:
+        yield None
+        return
+
+    parent = current_step.get()
+    record = {
+        "step": f"{parent['step']} > {name}" if parent else name,
+        "seconds": 0.0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+    }
+    # in order of start, steps called from this one follow it
+    profile.steps.append(record)
+    token = current_step.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - started
+        current_step.reset(token)
+
+
+def timed(name: str):
+    """Profile calls of an async function as a step"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if current.get() is None:
+                return await func(*args, **kwargs)
+            with step(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_usage(response):
+    """Add token usage of an OpenAI response to the running step"""
+    record = current_step.get()
+    usage = getattr(response, "usage", None)
+    if record is None or usage is None:
+        return
+    # responses report input/output tokens, embeddings prompt tokens only
+    record["input_tokens"] += getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", 0) or 0
+    record["output_tokens"] += getattr(usage, "output_tokens", 0) or 0
+
+
+def start_capture(capture: str | None):
+    if capture == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if capture == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        return profiler
+    return None
+
+
+def stop_capture(profiler) -> str:
+    if profiler is None:
+        return ""
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(CPROFILE_LINES)
+        return output.getvalue()
+    profiler.stop()
+    return profiler.output_text()
+
+
+@asynccontextmanager
+async def profile_query(capture: str | None = None):
+    """Profile the steps awaited inside the block"""
+    profile = QueryProfile(capture)
+    token = current.set(profile)
+    profiler = start_capture(capture)
+    started = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.seconds = time.perf_counter() - started
+        profile.report = stop_capture(profiler)
+        current.reset(token)
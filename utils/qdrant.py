@@ -1,10 +1,26 @@
 from qdrant_client import AsyncQdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct, ScoredPoint
+from qdrant_client.models import (
+    PointStruct,
+    ScoredPoint,
+    Filter,
+    FieldCondition,
+    MatchValue,
+    Range,
+)
 from dotenv import load_dotenv
+import asyncio
 import os
 import numpy as np
 import openai
+import tiktoken
+from scheduler import scheduler, estimate_tokens, INTERACTIVE
+from vector_backend import QdrantBackend, LocalBackend
+import profiling
 import logging
+import json
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 
 log = logging.getLogger(__name__)
@@ -16,48 +32,174 @@ QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT", None)
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
 QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "test")
 VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 768))
+# qdrant or local (embedded NumPy index, see vector_backend.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", f"data/{QDRANT_COLLECTION}")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", 8))
+# HNSW graph per tenant instead of a global one, see vector_backend.py
+MULTITENANT = os.getenv("MULTITENANT", "0") == "1"
+# two-stage search: prefix vectors of this size searched first, 0 disables (see vector_backend.py)
+MATRYOSHKA_DIM = int(os.getenv("MATRYOSHKA_DIM", 0))
+# tenant of CLI searches and upserts, empty searches all tenants
+TENANT_ID = os.getenv("TENANT_ID", "")
+# precomputed answers of frequent questions (FAQ_ANSWERS in functions/analyze), enable the
+# lookup together with FAQ_ANSWERS once the FAQ collection exists, otherwise every query pays for a failed search
+QDRANT_FAQ_COLLECTION = os.getenv("QDRANT_FAQ_COLLECTION", f"{QDRANT_COLLECTION}_faq")
+FAQ_LOOKUP = os.getenv("FAQ_LOOKUP", "0") == "1"
+# a question this similar to a stored one is answered without generation
+FAQ_SIMILARITY = float(os.getenv("FAQ_SIMILARITY", 0.9))
 
-assert QDRANT_ENDPOINT, "QDRANT_ENDPOINT environment variable is not set"
-assert QDRANT_API_KEY, "QDRANT_API_KEY environment variable is not set"
 assert VECTOR_SIZE, "VECTOR_SIZE environment variable is not set"
+assert VECTOR_BACKEND in ("qdrant", "local"), "VECTOR_BACKEND must be qdrant or local"
 
-client = AsyncQdrantClient(url=f"{QDRANT_ENDPOINT}:6333", api_key=QDRANT_API_KEY)
+if VECTOR_BACKEND == "qdrant":
+    assert QDRANT_ENDPOINT, "QDRANT_ENDPOINT environment variable is not set"
+    assert QDRANT_API_KEY, "QDRANT_API_KEY environment variable is not set"
+
+    client = AsyncQdrantClient(url=f"{QDRANT_ENDPOINT}:6333", api_key=QDRANT_API_KEY)
+    backend = QdrantBackend(
+        client, QDRANT_COLLECTION, VECTOR_SIZE, multitenant=MULTITENANT, prefix_dim=MATRYOSHKA_DIM
+    )
+    faq_backend = QdrantBackend(client, QDRANT_FAQ_COLLECTION, VECTOR_SIZE, multitenant=MULTITENANT)
+else:
+    client = None
+    backend = LocalBackend(LOCAL_INDEX_PATH, VECTOR_SIZE, nprobe=LOCAL_INDEX_NPROBE, prefix_dim=MATRYOSHKA_DIM)
+    faq_backend = LocalBackend(f"{LOCAL_INDEX_PATH}_faq", VECTOR_SIZE)
 
 # Replace dotenv with Secret Manager
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", False)
 assert OPENAI_API_KEY, "OPENAI_API_KEY environment variable is not set"
 
 # Initialize OpenAI client
-openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
-
-
+# retries are handled by the scheduler
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# Context packing for retrieve_and_summarize
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+CONTEXT_SEARCH_LIMIT = int(os.getenv("CONTEXT_SEARCH_LIMIT", 10))
+# shards above this size are reduced by summarize_knowledge_bit before packing
+MAX_SHARD_TOKENS = int(os.getenv("MAX_SHARD_TOKENS", 2000))
+# shortest common text considered an overlap between two shards
+MIN_OVERLAP_CHARS = 64
+
+# conversation sessions of retrieve_and_summarize (--chat), kept in process memory
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 100))
+SESSION_TTL = int(os.getenv("SESSION_TTL", 1800))
+# retrieved shards and question/answer turns kept per session
+SESSION_MAX_SHARDS = int(os.getenv("SESSION_MAX_SHARDS", 30))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", 6))
+
+encoding = tiktoken.get_encoding("o200k_base")  # gpt-4o family
+
+
+class ChatSession:
+    """Retrieved shards, their extractions and the turns of a conversation, reused by follow-ups"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.last_used = time.time()
+        # point id -> information shard, least recently retrieved first
+        self.shards: OrderedDict = OrderedDict()
+        # shard -> details extracted from it by summarize_knowledge_bit
+        self.extractions: OrderedDict[str, str] = OrderedDict()
+        self.turns: list[tuple[str, str]] = []
+
+    def add_shards(self, shards: dict):
+        for point_id, shard in shards.items():
+            self.shards[point_id] = shard
+            self.shards.move_to_end(point_id)
+        while len(self.shards) > SESSION_MAX_SHARDS:
+            self.shards.popitem(last=False)
+        while len(self.extractions) > SESSION_MAX_SHARDS:
+            self.extractions.popitem(last=False)
+
+    def add_turn(self, question: str, answer: str):
+        self.turns = (self.turns + [(question, answer)])[-SESSION_MAX_TURNS:]
+
+
+sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+
+def get_session(session_id: str | None = None) -> ChatSession:
+    """Session of the id, a new one if it does not exist or has expired"""
+    for stale_id in [key for key, session in sessions.items() if time.time() - session.last_used > SESSION_TTL]:
+        sessions.pop(stale_id)
+
+    session_id = session_id or uuid.uuid4().hex
+    session = sessions.pop(session_id, None) or ChatSession(session_id)
+    session.last_used = time.time()
+    sessions[session_id] = session
+    # least recently used sessions are dropped first
+    while len(sessions) > SESSION_CACHE_SIZE:
+        sessions.popitem(last=False)
+    return session
+
+
+@profiling.timed("embedding")
 async def create_embedding(text: str) -> list[float]:
-    response = await openai_client.embeddings.create(
+    response = await scheduler.acall(
+        openai_client.embeddings.create,
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_tokens(text),
         model="text-embedding-3-small",
         input=text,
         dimensions=VECTOR_SIZE,
     )
+    profiling.record_usage(response)
 
     return response.data[0].embedding
 
 
 async def create_qdrant_collection():
-    # Your async code using QdrantClient might be put here
-
-    if not await client.collection_exists(QDRANT_COLLECTION):
-        await client.create_collection(
-            collection_name=QDRANT_COLLECTION,
-            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+    await backend.create()
+    await faq_backend.create()
+
+
+async def create_payload_indexes():
+    assert VECTOR_BACKEND == "qdrant", "Payload indexes are only used by the qdrant backend"
+    await backend.create_payload_indexes()
+
+
+def build_filter(
+    tenant_id: str | None = None,
+    source: str | None = None,
+    media_type: str | None = None,
+    language: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+) -> Filter | None:
+    """Build a payload filter restricting search to given tenant, source, media type, language and ingest date range"""
+    conditions = [
+        FieldCondition(key=key, match=MatchValue(value=value))
+        for key, value in (
+            ("tenant_id", tenant_id),
+            ("source", source),
+            ("media_type", media_type),
+            ("language", language),
         )
+        if value
+    ]
+    if since or until:
+        conditions.append(
+            FieldCondition(
+                key="ingested_at",
+                range=Range(
+                    gte=since.timestamp() if since else None,
+                    lte=until.timestamp() if until else None,
+                ),
+            )
+        )
+
+    return Filter(must=conditions) if conditions else None
 
 
 async def delete_qdrant_collection():
-    pass
+    await backend.delete()
+    await faq_backend.delete()
 
 
 async def random_upsert():
-    await client.upsert(
-        collection_name=QDRANT_COLLECTION,
+    await backend.upsert(
         points=[
             PointStruct(
                 id=i,
@@ -69,17 +211,64 @@ async def random_upsert():
     )
 
 
-async def search(search_phrase: str, limit: int = 5) -> list[ScoredPoint]:
-    log.info(f"Creating embeddings for: {search_phrase}")
-    query_vector = await create_embedding(search_phrase)
+async def upsert_knowledge(knowledge_files: list[str], tenant_id: str = ""):
+    """Upsert knowledge files written by functions/analyze, e.g. to fill the local backend"""
+    points, faq_points = [], []
+    for i, knowledge_file in enumerate(knowledge_files):
+        with open(knowledge_file, "r") as f:
+            knowledge = json.load(f)
+        payload = {
+            "information_shard": knowledge["information"],
+            "source": knowledge.get("source") or os.path.basename(knowledge_file).removesuffix("_knowledge.json"),
+            "media_type": knowledge.get("media_type", "text"),
+            "chunk_index": knowledge.get("chunk_index", 0),
+            "ingested_at": int(time.time()),
+            "language": knowledge["analysis"].get("language", ""),
+            # same as functions/upsert, the text the vector is the embedding of
+            "analysis_text": "\n".join(knowledge["analysis"].get("phrases", []))
+            + "\n".join(knowledge["analysis"].get("keypoints", [])),
+        }
+        if knowledge.get("tenant_id") or tenant_id:
+            payload["tenant_id"] = knowledge.get("tenant_id") or tenant_id
+        shard_id = int(time.time() * 1e6) + i
+        points.append(PointStruct(id=shard_id, vector=knowledge["embeddings"], payload=payload))
+
+        # same FAQ points as functions/upsert writes
+        faq_payload = {
+            key: value for key, value in payload.items() if key not in ("information_shard", "analysis_text")
+        }
+        faq_points.extend(
+            PointStruct(
+                id=str(uuid.uuid5(uuid.NAMESPACE_OID, f"{shard_id}:{j}")),
+                vector=faq["embeddings"],
+                payload={**faq_payload, "shard_id": shard_id, "question": faq["question"], "answer": faq["answer"]},
+            )
+            for j, faq in enumerate(knowledge.get("faq", []))
+        )
+
+    await backend.upsert(points)
+    if faq_points:
+        await faq_backend.upsert(faq_points)
+    log.info(f"Upserted {len(points)} knowledge points and {len(faq_points)} FAQ answers")
+
+
+@profiling.timed("search")
+async def search(
+    search_phrase: str,
+    limit: int = 5,
+    query_filter: Filter | None = None,
+    query_vector: list[float] | None = None,
+) -> list[ScoredPoint]:
+    if query_vector is None:
+        log.info(f"Creating embeddings for: {search_phrase}")
+        query_vector = await create_embedding(search_phrase)
 
     log.info(f"Searching for: {search_phrase}")
-    res = await client.query_points(
-        collection_name=QDRANT_COLLECTION,
-        query=query_vector,  # type: ignore
-        limit=limit,
-    )
-    res = res.points
+    res = await backend.search(query_vector, limit=limit, query_filter=query_filter)
+
+    if not res:
+        log.warning(f"No points found for: {search_phrase}")
+        return res
 
     max_similarity = max([point.score for point in res])
     log.info(f"Max similarity: {max_similarity}")
@@ -87,8 +276,12 @@ async def search(search_phrase: str, limit: int = 5) -> list[ScoredPoint]:
     return res
 
 
+@profiling.timed("extract")
 async def summarize_knowledge_bit(knowledge: str, question: str) -> str:
-    response = await openai_client.responses.create(
+    response = await scheduler.acall(
+        openai_client.responses.create,
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_tokens(knowledge, question),
         model="gpt-4o-mini",
         input=[
             {"role": "developer", "content": knowledge},
@@ -104,26 +297,34 @@ async def summarize_knowledge_bit(knowledge: str, question: str) -> str:
             Current date and time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
             """,
     )
+    profiling.record_usage(response)
     log.info(f"Summarized knowledge bit: {response.output_text}")
 
     return response.output_text
 
 
 async def delete_collection():
-    await client.delete_collection(collection_name=QDRANT_COLLECTION)
+    await delete_qdrant_collection()
 
 
 async def collection_info():
-    count = await client.count(collection_name=QDRANT_COLLECTION)
-    info = await client.info()
+    count = await backend.count()
+    info = await client.info() if client else {"backend": VECTOR_BACKEND, "path": LOCAL_INDEX_PATH}
     return {"count": count, "info": info}
 
 
-async def summarize(question: str, knowledge_bits: list[str]) -> str:
+@profiling.timed("summarize")
+async def summarize(question: str, knowledge_bits: list[str], history: list[tuple[str, str]] | None = None) -> str:
     input_data = [{"role": "developer", "content": bit} for bit in knowledge_bits]
+    for asked, answered in history or []:
+        input_data.append({"role": "user", "content": asked})
+        input_data.append({"role": "assistant", "content": answered})
     input_data.append({"role": "user", "content": question})
 
-    response = await openai_client.responses.create(
+    response = await scheduler.acall(
+        openai_client.responses.create,
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_tokens(*knowledge_bits, *(text for turn in history or [] for text in turn), question),
         model="gpt-4o-mini",
         input=input_data,
         tools=[{"type": "web_search_preview"}],
@@ -137,12 +338,17 @@ async def summarize(question: str, knowledge_bits: list[str]) -> str:
             Current date and time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
             """,
     )
+    profiling.record_usage(response)
 
     return response.output_text
 
 
+@profiling.timed("web_search")
 async def web_search(keywords: str) -> str:
-    response = await openai_client.responses.create(
+    response = await scheduler.acall(
+        openai_client.responses.create,
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_tokens(keywords),
         model="gpt-4o-mini",
         tools=[
             {
@@ -152,12 +358,17 @@ async def web_search(keywords: str) -> str:
         ],
         input=keywords,
     )
+    profiling.record_usage(response)
 
     return response.output_text
 
 
+@profiling.timed("craft_query")
 async def craft_knowledge_query(question: str) -> str:
-    response = await openai_client.responses.create(
+    response = await scheduler.acall(
+        openai_client.responses.create,
+        priority=INTERACTIVE,
+        estimated_tokens=estimate_tokens(question),
         model="gpt-4o-mini",
         instructions=f"""
             Determine what you need to know to answer the question. Craft a set of keywords suitable 
@@ -167,23 +378,214 @@ async def craft_knowledge_query(question: str) -> str:
             """,
         input=question,
     )
+    profiling.record_usage(response)
     query = response.output_text
     log.info(f"Crafted query: {query}")
     print(f"Searching for: {query} ... ")
     return query
 
 
-async def retrieve_and_summarize(question: str) -> str:
-    query = await craft_knowledge_query(question)
-    points = await search(question)
-    knowledge = [point.payload.get("information_shard") for point in points]
-    #  = await web_search(question)
-    knowledge_bits = [await summarize_knowledge_bit(bit, query) for bit in knowledge]
-    return await summarize(question, knowledge_bits)
+def count_tokens(text: str) -> int:
+    return len(encoding.encode(text))
+
+
+def _trim_overlap(shard: str, other: str) -> str:
+    """Cut the part of shard which overlaps with the head or tail of other shard"""
+    if len(shard) < MIN_OVERLAP_CHARS:
+        return shard
+
+    # shard continues other: tail of other == head of shard
+    pos = other.find(shard[:MIN_OVERLAP_CHARS])
+    if pos != -1 and shard.startswith(other[pos:]):
+        shard = shard[len(other) - pos :]
+
+    if len(shard) < MIN_OVERLAP_CHARS:
+        return shard
+
+    # shard precedes other: tail of shard == head of other
+    pos = other.find(shard[-MIN_OVERLAP_CHARS:])
+    if pos != -1 and shard.endswith(other[: pos + MIN_OVERLAP_CHARS]):
+        shard = shard[: len(shard) - pos - MIN_OVERLAP_CHARS]
+
+    return shard
+
+
+def dedupe_shards(shards: list[str]) -> list[str]:
+    """Drop repeated shards and trim text overlapping with higher ranked ones, keeping the order"""
+    kept: list[str] = []
+    seen = set()
+    for shard in shards:
+        shard = (shard or "").strip()
+        if not shard or shard in seen or any(shard in other for other in kept):
+            continue
+        seen.add(shard)
+
+        # a longer shard covering already kept ones takes their place
+        covered = [i for i, other in enumerate(kept) if other in shard]
+        if covered:
+            kept[covered[0]] = shard
+            kept = [other for i, other in enumerate(kept) if i not in covered[1:]]
+            continue
+
+        for other in kept:
+            shard = _trim_overlap(shard, other).strip()
+        if shard:
+            kept.append(shard)
+
+    return kept
+
+
+@profiling.timed("pack_context")
+async def pack_context(
+    shards: list[str],
+    query: str,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    extractions: dict[str, str] | None = None,
+) -> str:
+    """Pack the best ranked shards into a single context under the token budget"""
+    packed = []
+    used = 0
+    for shard in dedupe_shards(shards):
+        tokens = count_tokens(shard)
+        if tokens > MAX_SHARD_TOKENS:
+            if extractions is not None and shard in extractions:
+                log.info(f"Shard has {tokens} tokens, reusing extracted details")
+                shard = extractions[shard]
+            else:
+                log.info(f"Shard has {tokens} tokens, extracting details")
+                extracted = await summarize_knowledge_bit(shard, query)
+                if extractions is not None:
+                    extractions[shard] = extracted
+                shard = extracted
+            tokens = count_tokens(shard)
+
+        if used + tokens > budget:
+            log.info(f"Shard with {tokens} tokens does not fit into budget ({used}/{budget})")
+            continue
+
+        packed.append(shard)
+        used += tokens
+
+    log.info(f"Packed {len(packed)}/{len(shards)} shards into {used} tokens")
+    return "\n\n---\n\n".join(packed)
+
+
+@profiling.timed("faq_lookup")
+async def answer_from_faq(query_vector: list[float], query_filter: Filter | None = None) -> str | None:
+    """Stored answer of a question similar enough to the asked one"""
+    try:
+        hits = await faq_backend.search(query_vector, limit=1, query_filter=query_filter)
+    except Exception as e:
+        log.warning(f"FAQ lookup failed: {e}")
+        return None
+
+    if hits and hits[0].score >= FAQ_SIMILARITY:
+        log.info(f"FAQ hit: {hits[0].payload.get('question')} (similarity {hits[0].score:.3f})")
+        return hits[0].payload.get("answer")
+    return None
+
+
+@profiling.timed("search")
+async def retrieve_session_shards(
+    session: ChatSession, query_vector: list[float], query_filter: Filter | None = None
+) -> list[str]:
+    """Shards found for the question followed by the rest of the session context, newest first.
+
+    The search returns ids only, payloads are fetched just for points not in the session yet.
+    """
+    hits = await backend.search(query_vector, limit=CONTEXT_SEARCH_LIMIT, query_filter=query_filter, with_payload=False)
+    missing = [hit.id for hit in hits if hit.id not in session.shards]
+    fetched = {}
+    if missing:
+        fetched = {record.id: record.payload.get("information_shard") for record in await backend.retrieve(missing)}
+    log.info(f"Found {len(hits)} shards, fetched {len(fetched)} not in session context")
+
+    found = {hit.id: session.shards.get(hit.id) or fetched.get(hit.id) for hit in hits}
+    earlier = [shard for point_id, shard in reversed(session.shards.items()) if point_id not in found]
+    session.add_shards(found)
+    return list(found.values()) + earlier
+
+
+async def retrieve_and_summarize(
+    question: str, query_filter: Filter | None = None, session: ChatSession | None = None
+) -> str:
+    follow_up = bool(session and session.turns)
+    # one embedding serves the FAQ lookup and the knowledge search,
+    # a follow-up is searched together with the previous question it refers to
+    query_vector = await create_embedding(f"{session.turns[-1][0]}\n{question}" if follow_up else question)
+    # stored answers are standalone, they do not answer follow-ups
+    if FAQ_LOOKUP and not follow_up and (answer := await answer_from_faq(query_vector, query_filter)):
+        if session:
+            session.add_turn(question, answer)
+        return answer
+
+    # extraction on follow-ups is directed by the question itself, the conversation gives the rest
+    query = question if follow_up else await craft_knowledge_query(question)
+    if session is None:
+        points = await search(
+            question, limit=CONTEXT_SEARCH_LIMIT, query_filter=query_filter, query_vector=query_vector
+        )
+        knowledge = [point.payload.get("information_shard") for point in points]
+        #  = await web_search(question)
+        context = await pack_context(knowledge, query)
+        return await summarize(question, [context])
+
+    knowledge = await retrieve_session_shards(session, query_vector, query_filter)
+    context = await pack_context(knowledge, query, extractions=session.extractions)
+    answer = await summarize(question, [context], history=session.turns)
+    session.add_turn(question, answer)
+    return answer
+
+
+async def profile_answer(
+    question: str,
+    query_filter: Filter | None = None,
+    session: ChatSession | None = None,
+    capture: str | None = None,
+) -> tuple[str, profiling.QueryProfile]:
+    """Answer with the per-step latency and token breakdown of the query"""
+    async with profiling.profile_query(capture) as profile:
+        answer = await retrieve_and_summarize(question, query_filter=query_filter, session=session)
+    return answer, profile
+
+
+def write_profile(path: str, question: str, profile: profiling.QueryProfile):
+    """Append the profile of a query to a JSONL file"""
+    with open(path, "a") as f:
+        record = {"question": question, "started": datetime.now().isoformat(), **profile.breakdown()}
+        f.write(json.dumps({**record, "report": profile.report}, ensure_ascii=False) + "\n")
+    log.info(f"Profile written to {path}")
+
+
+async def ask(
+    question: str,
+    query_filter: Filter | None = None,
+    session: ChatSession | None = None,
+    profile_path: str | None = None,
+    capture: str | None = None,
+) -> str:
+    if not profile_path:
+        return await retrieve_and_summarize(question, query_filter=query_filter, session=session)
+
+    answer, profile = await profile_answer(question, query_filter, session, capture)
+    print(profile.summary())
+    write_profile(profile_path, question, profile)
+    return answer
+
+
+async def chat(query_filter: Filter | None = None, profile_path: str | None = None, capture: str | None = None):
+    """Answer questions from stdin in one session until EOF"""
+    session = get_session()
+    while True:
+        try:
+            question = (await asyncio.to_thread(input, "> ")).strip()
+        except EOFError:
+            break
+        if question:
+            print(await ask(question, query_filter, session, profile_path, capture))
 
 
 if __name__ == "__main__":
-    import asyncio
     import argparse
 
     parser = argparse.ArgumentParser(description="Qdrant collection of utils")
@@ -195,7 +597,40 @@ if __name__ == "__main__":
     group.add_argument("-r", "--random", action="store_true", help="Upsert random into a Qdrant collection")
     group.add_argument("-s", "--search", help="Search a Qdrant collection")
     group.add_argument("--ai", help="Search the knowledge and summarize the response")
+    group.add_argument("--chat", action="store_true", help="Answer questions from stdin, follow-ups reuse context")
+    group.add_argument("--indexes", action="store_true", help="Create payload indexes on an existing collection")
+    group.add_argument("-u", "--upsert", nargs="+", help="Upsert knowledge JSON files")
+    group.add_argument("--build-ivf", type=int, metavar="LISTS", help="Partition the local index into IVF lists")
+    # payload filters for --search and --ai
+    parser.add_argument("--tenant", default=TENANT_ID, help="Restrict search (and tag upserts) to a tenant")
+    parser.add_argument("--source", help="Restrict search to a source file, e.g. zakon206.mp3")
+    parser.add_argument("--media-type", choices=["audio", "document", "text"], help="Restrict search to a media type")
+    parser.add_argument("--language", help="Restrict search to a language code, e.g. sk")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Restrict search to knowledge ingested since date")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Restrict search to knowledge ingested until date")
+    # profiling of --ai and --chat
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="query_profile.jsonl",
+        metavar="FILE",
+        help="Print per-step timings and token usage of every answer and append them to FILE",
+    )
+    parser.add_argument(
+        "--profile-capture", choices=profiling.CAPTURES, help="Also capture the query with cProfile or pyinstrument"
+    )
     args = parser.parse_args()
+    if args.profile_capture and not args.profile:
+        parser.error("--profile-capture requires --profile")
+
+    query_filter = build_filter(
+        tenant_id=args.tenant,
+        source=args.source,
+        media_type=args.media_type,
+        language=args.language,
+        since=args.since,
+        until=args.until,
+    )
 
     if args.create:
         asyncio.run(create_qdrant_collection())
@@ -206,11 +641,20 @@ if __name__ == "__main__":
         print(f"Collection info: {res}")
     elif args.random:
         asyncio.run(random_upsert())
+    elif args.indexes:
+        asyncio.run(create_payload_indexes())
+    elif args.upsert:
+        asyncio.run(upsert_knowledge(args.upsert, args.tenant))
+    elif args.build_ivf:
+        assert VECTOR_BACKEND == "local", "IVF partitioning is only used by the local backend"
+        backend.build_ivf(args.build_ivf)
     elif args.search:
-        res = asyncio.run(search(args.search))
+        res = asyncio.run(search(args.search, query_filter=query_filter))
         print(res)
     elif args.ai:
-        knowledge = asyncio.run(retrieve_and_summarize(args.ai))
+        knowledge = asyncio.run(ask(args.ai, query_filter, profile_path=args.profile, capture=args.profile_capture))
         print(knowledge)
+    elif args.chat:
+        asyncio.run(chat(query_filter, profile_path=args.profile, capture=args.profile_capture))
     else:
         parser.print_help()
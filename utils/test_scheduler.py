@@ -0,0 +1,69 @@
+"""Scheduler checks against the rate limited fake OpenAI server of fake_openai.py.
+
+    pytest utils/test_scheduler.py
+"""
+
+import asyncio
+
+import pytest
+
+import fake_openai
+import scheduler
+from scheduler import INTERACTIVE, BULK, LocalLimiter, RedisLimiter, Scheduler
+
+MODEL = "text-embedding-3-small"
+RPM = 600
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_TEXT_EMBEDDING_3_SMALL", f"{RPM},0")
+    monkeypatch.setattr(fake_openai.RateLimitedHandler, "buckets", {})
+    monkeypatch.setattr(fake_openai.RateLimitedHandler, "accepted", 0)
+    monkeypatch.setattr(fake_openai.RateLimitedHandler, "rejected", 0)
+    server = fake_openai.serve(RPM)
+    yield server.server_address[1]
+    server.shutdown()
+
+
+@pytest.fixture
+def redis_limiter(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis
+
+    monkeypatch.setattr(redis.Redis, "from_url", staticmethod(lambda url: fakeredis.FakeRedis()))
+    return RedisLimiter("redis://fake")
+
+
+def check_lanes(port: int, limiter):
+    scheduler = Scheduler(limiter)
+    # empty buckets, so the bulk backlog queues and interactive requests arrive behind it
+    limiter.rate_limited(MODEL)
+    latencies, failures = asyncio.run(fake_openai.drive(port, bulk=40, interactive=8, delay=1.0, scheduler=scheduler))
+
+    assert failures == {INTERACTIVE: 0, BULK: 0}
+    assert len(latencies[INTERACTIVE]) == 8 and len(latencies[BULK]) == 40
+    assert fake_openai.percentile(latencies[INTERACTIVE], 0.5) < fake_openai.percentile(latencies[BULK], 0.5)
+
+
+def test_interactive_goes_first(server):
+    check_lanes(server, LocalLimiter())
+
+
+def test_interactive_goes_first_shared(server, redis_limiter):
+    check_lanes(server, redis_limiter)
+
+
+@pytest.mark.parametrize("value", ["500", "500,", "a,b", "500,200000,1", "-1,0"])
+def test_invalid_limit_override(monkeypatch, value):
+    monkeypatch.setenv("RATE_LIMIT_GPT_4O_MINI", value)
+    with pytest.raises(ValueError, match="RATE_LIMIT_GPT_4O_MINI"):
+        scheduler.model_limits("gpt-4o-mini")
+    with pytest.raises(ValueError, match="RATE_LIMIT_GPT_4O_MINI"):
+        scheduler.check_limit_overrides()
+
+
+def test_limit_override(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_GPT_4O_MINI", "100,0")
+    assert scheduler.model_limits("gpt-4o-mini") == (100, 0)
+    assert scheduler.model_limits("gpt-4o-mini", share=0.5) == (50, 0)
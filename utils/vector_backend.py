@@ -0,0 +1,483 @@
+"""Vector index backends behind the search/upsert interface of utils/qdrant.py.
+
+- QdrantBackend: remote Qdrant collection (default).
+- LocalBackend: embedded index for dev, CI and small deployments. Vectors are kept
+  normalized in a memory-mapped float32 matrix, cosine top-k is a single matrix-vector
+  product. Optional IVF partitioning (k-means lists, `nprobe` nearest lists searched)
+  limits the scanned rows for larger sets. Payload filters are evaluated as boolean masks
+  over payload columns, built per key on first use.
+
+Select with VECTOR_BACKEND=qdrant|local, the local index is stored in LOCAL_INDEX_PATH.
+
+With MATRYOSHKA_DIM set, every point also stores the renormalized prefix of its vector
+(text-embedding-3 vectors keep most information in the leading dimensions). Search scans
+the short prefixes for a large candidate pool and rescores only the candidates with the
+full vectors, which stay on disk (Qdrant named vectors "prefix"/"full", prefetch + rescore).
+
+With MULTITENANT=1 the Qdrant collection also builds an HNSW graph per tenant_id
+(payload_m), so tenant-scoped search latency depends on the tenant's size only. The
+global graph is kept, so searches without tenant filter (points of the default tenant "",
+CLI searches of all tenants) do not fall back to a full scan.
+"""
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    VectorParams,
+    Distance,
+    PointStruct,
+    ScoredPoint,
+    Record,
+    Filter,
+    FieldCondition,
+    MatchValue,
+    MatchAny,
+    PayloadSchemaType,
+    KeywordIndexParams,
+    HnswConfigDiff,
+    IsEmptyCondition,
+    Prefetch,
+)
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# structured payload attached by functions/upsert, indexed for filtered search
+PAYLOAD_INDEXES = {
+    "source": PayloadSchemaType.KEYWORD,
+    "media_type": PayloadSchemaType.KEYWORD,
+    "language": PayloadSchemaType.KEYWORD,
+    "chunk_index": PayloadSchemaType.INTEGER,
+    "ingested_at": PayloadSchemaType.INTEGER,
+    "minhash_bands": PayloadSchemaType.KEYWORD,  # LSH candidates for dedupe in functions/upsert
+    # points of one tenant are stored together and searched through their own HNSW graph
+    "tenant_id": KeywordIndexParams(type="keyword", is_tenant=True),
+}
+
+# HNSW graph per tenant_id value next to the global one, m=0 would leave searches
+# without tenant filter to a full scan
+TENANT_HNSW = HnswConfigDiff(payload_m=16, m=16)
+
+# named vectors of two-stage (Matryoshka) collections
+FULL = "full"
+PREFIX = "prefix"
+# candidates of the prefix search rescored with full vectors, per requested result
+PREFETCH_FACTOR = 20
+MIN_PREFETCH = 100
+
+
+def prefix_vector(vector: list[float], dim: int) -> list[float]:
+    prefix = np.asarray(vector[:dim], dtype=np.float32)
+    norm = np.linalg.norm(prefix)
+    return (prefix / norm if norm else prefix).tolist()
+
+
+def prefetch_limit(limit: int) -> int:
+    return max(MIN_PREFETCH, limit * PREFETCH_FACTOR)
+
+
+class QdrantBackend:
+    def __init__(
+        self,
+        client: AsyncQdrantClient,
+        collection: str,
+        vector_size: int,
+        multitenant: bool = False,
+        prefix_dim: int = 0,
+    ):
+        self.client = client
+        self.collection = collection
+        self.vector_size = vector_size
+        self.multitenant = multitenant
+        self.prefix_dim = prefix_dim
+
+    def vectors_config(self) -> VectorParams | dict[str, VectorParams]:
+        if not self.prefix_dim:
+            return VectorParams(size=self.vector_size, distance=Distance.COSINE)
+        return {
+            # full vectors are read only to rescore candidates, kept on disk
+            FULL: VectorParams(size=self.vector_size, distance=Distance.COSINE, on_disk=True),
+            PREFIX: VectorParams(size=self.prefix_dim, distance=Distance.COSINE),
+        }
+
+    async def create(self):
+        hnsw_config = TENANT_HNSW if self.multitenant else None
+        if not await self.client.collection_exists(self.collection):
+            await self.client.create_collection(
+                collection_name=self.collection,
+                vectors_config=self.vectors_config(),
+                hnsw_config=hnsw_config,
+            )
+        elif hnsw_config:
+            # existing collections are re-indexed per tenant in the background
+            await self.client.update_collection(collection_name=self.collection, hnsw_config=hnsw_config)
+
+        await self.create_payload_indexes()
+
+    async def create_payload_indexes(self):
+        for field_name, field_schema in PAYLOAD_INDEXES.items():
+            log.info(f"Creating payload index: {field_name} ({getattr(field_schema, 'type', field_schema)})")
+            await self.client.create_payload_index(
+                collection_name=self.collection,
+                field_name=field_name,
+                field_schema=field_schema,
+                wait=True,
+            )
+
+    async def delete(self):
+        await self.client.delete_collection(collection_name=self.collection)
+
+    async def count(self) -> int:
+        return (await self.client.count(collection_name=self.collection)).count
+
+    def point_vector(self, vector: list[float] | dict) -> list[float] | dict[str, list[float]]:
+        """Vector in the layout of this collection, points may come from a collection with the other one"""
+        full = vector[FULL] if isinstance(vector, dict) else vector
+        if not self.prefix_dim:
+            return full
+        return {FULL: full, PREFIX: prefix_vector(full, self.prefix_dim)}
+
+    async def upsert(self, points: list[PointStruct]):
+        points = [point.model_copy(update={"vector": self.point_vector(point.vector)}) for point in points]
+        await self.client.upsert(collection_name=self.collection, points=points, wait=True)
+
+    async def search(
+        self,
+        vector: list[float],
+        limit: int = 5,
+        query_filter: Filter | None = None,
+        with_payload: bool = True,
+    ) -> list[ScoredPoint]:
+        if not self.prefix_dim:
+            res = await self.client.query_points(
+                collection_name=self.collection,
+                query=vector,  # type: ignore
+                query_filter=query_filter,
+                limit=limit,
+                with_payload=with_payload,
+            )
+            return res.points
+
+        res = await self.client.query_points(
+            collection_name=self.collection,
+            prefetch=Prefetch(
+                query=prefix_vector(vector, self.prefix_dim),
+                using=PREFIX,
+                filter=query_filter,
+                limit=prefetch_limit(limit),
+            ),
+            query=vector,  # type: ignore
+            using=FULL,
+            limit=limit,
+            with_payload=with_payload,
+        )
+        return res.points
+
+    async def retrieve(self, ids: list) -> list[Record]:
+        return await self.client.retrieve(collection_name=self.collection, ids=ids, with_payload=True)
+
+
+def _conditions(conditions) -> list:
+    return conditions if isinstance(conditions, list) else [conditions] if conditions else []
+
+
+def check_filter(query_filter: Filter):
+    """Raise ValueError for conditions the local backend can not evaluate, before any scan"""
+    if query_filter.min_should is not None:
+        raise ValueError("Local backend does not support min_should filters")
+    for clause in (query_filter.must, query_filter.must_not, query_filter.should):
+        for condition in _conditions(clause):
+            if isinstance(condition, Filter):
+                check_filter(condition)
+            elif isinstance(condition, IsEmptyCondition):
+                continue
+            elif not isinstance(condition, FieldCondition) or not (
+                isinstance(condition.match, (MatchValue, MatchAny))
+                or (condition.match is None and condition.range is not None)
+            ):
+                raise ValueError(f"Local backend does not support condition {condition}")
+
+
+def _scalar(value) -> bool:
+    return isinstance(value, (str, int, float, bool))
+
+
+class LocalBackend:
+    VECTORS = "vectors.f32"
+    PAYLOADS = "payloads.jsonl"
+    IVF = "ivf.npz"
+    PREFIX = "prefix.f32"
+
+    def __init__(self, path: str, vector_size: int, nprobe: int = 8, prefix_dim: int = 0):
+        self.path = path
+        self.vector_size = vector_size
+        self.nprobe = nprobe
+        self.prefix_dim = prefix_dim
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        self.ids: list = []
+        self.payloads: list[dict] = []
+        if os.path.exists(self._file(self.PAYLOADS)):
+            with open(self._file(self.PAYLOADS), "r") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.ids.append(record["id"])
+                    self.payloads.append(record["payload"])
+        self.rows = {point_id: row for row, point_id in enumerate(self.ids)}
+        # payload columns built on first use by filtered search, per key
+        self._postings: dict[str, dict] = {}
+        self._numbers: dict[str, np.ndarray] = {}
+        self._empty: dict[str, np.ndarray] = {}
+
+        self.vectors = np.zeros((0, self.vector_size), dtype=np.float32)
+        if self.ids:
+            self.vectors = np.memmap(
+                self._file(self.VECTORS), dtype=np.float32, mode="r", shape=(len(self.ids), self.vector_size)
+            )
+
+        self.centroids = None
+        self.lists = None
+        if os.path.exists(self._file(self.IVF)):
+            ivf = np.load(self._file(self.IVF))
+            self.centroids, self.lists = ivf["centroids"], ivf["lists"]
+
+        self.prefix = None
+        if self.prefix_dim and self.ids:
+            shape = (len(self.ids), self.prefix_dim)
+            path = self._file(self.PREFIX)
+            if not os.path.exists(path) or os.path.getsize(path) != shape[0] * shape[1] * 4:
+                self._build_prefix()
+            self.prefix = np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+
+    def _build_prefix(self, batch: int = 50_000):
+        """Write prefix vectors of an index built without them (or with another prefix_dim)"""
+        with open(self._file(self.PREFIX), "wb") as f:
+            for i in range(0, len(self.ids), batch):
+                f.write(self._normalize(np.asarray(self.vectors[i : i + batch, : self.prefix_dim])).tobytes())
+        log.info(f"Built {self.prefix_dim}-d prefix vectors for {len(self.ids)} points")
+
+    async def create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    async def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._load()
+
+    async def count(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    async def upsert(self, points: list[PointStruct]):
+        os.makedirs(self.path, exist_ok=True)
+        vectors = self._normalize(np.asarray([point.vector for point in points], dtype=np.float32))
+
+        updates = [(self.rows[point.id], i) for i, point in enumerate(points) if point.id in self.rows]
+        new = [i for i, point in enumerate(points) if point.id not in self.rows]
+
+        if updates:
+            matrix = np.memmap(self._file(self.VECTORS), dtype=np.float32, mode="r+", shape=self.vectors.shape)
+            for row, i in updates:
+                matrix[row] = vectors[i]
+                self.payloads[row] = points[i].payload or {}
+            matrix.flush()
+
+        with open(self._file(self.VECTORS), "ab") as f:
+            f.write(vectors[new].tobytes())
+
+        if self.prefix is not None:
+            prefixes = self._normalize(vectors[:, : self.prefix_dim])
+            if updates:
+                matrix = np.memmap(self._file(self.PREFIX), dtype=np.float32, mode="r+", shape=self.prefix.shape)
+                for row, i in updates:
+                    matrix[row] = prefixes[i]
+                matrix.flush()
+            with open(self._file(self.PREFIX), "ab") as f:
+                f.write(prefixes[new].tobytes())
+
+        for i in new:
+            self.ids.append(points[i].id)
+            self.payloads.append(points[i].payload or {})
+
+        # payloads are small compared to vectors, rewrite them as a whole
+        with open(self._file(self.PAYLOADS), "w") as f:
+            for point_id, payload in zip(self.ids, self.payloads):
+                f.write(json.dumps({"id": point_id, "payload": payload}) + "\n")
+
+        if self.lists is not None:
+            # assign new and updated vectors to their nearest IVF list
+            assignments = np.argmax(vectors @ self.centroids.T, axis=1).astype(self.lists.dtype)
+            for row, i in updates:
+                self.lists[row] = assignments[i]
+            self.lists = np.concatenate([self.lists, assignments[new]])
+            np.savez(self._file(self.IVF), centroids=self.centroids, lists=self.lists)
+
+        self._load()
+
+    def build_ivf(self, n_lists: int, iterations: int = 10, sample: int = 50_000, seed: int = 0):
+        """Partition vectors into n_lists k-means (spherical) clusters"""
+        rng = np.random.default_rng(seed)
+        n = len(self.ids)
+        assert n >= n_lists, f"Index has {n} vectors, less than {n_lists} lists"
+
+        training = np.asarray(self.vectors[rng.choice(n, size=min(n, sample), replace=False)])
+        centroids = training[rng.choice(len(training), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(training @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = training[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = self._normalize(centroids)
+
+        lists = np.concatenate(
+            [np.argmax(self.vectors[i : i + sample] @ centroids.T, axis=1) for i in range(0, n, sample)]
+        ).astype(np.int32)
+        np.savez(self._file(self.IVF), centroids=centroids, lists=lists)
+        self.centroids, self.lists = centroids, lists
+        log.info(f"Built IVF index with {n_lists} lists over {n} vectors")
+
+    def drop_ivf(self):
+        if os.path.exists(self._file(self.IVF)):
+            os.remove(self._file(self.IVF))
+        self.centroids = self.lists = None
+
+    def _candidates(self, query: np.ndarray) -> np.ndarray | None:
+        """Rows of the nprobe lists closest to the query, None to scan everything"""
+        if self.lists is None:
+            return None
+        probes = np.argsort(-(self.centroids @ query))[: self.nprobe]
+        return np.flatnonzero(np.isin(self.lists, probes))
+
+    def _prefetch(self, query: np.ndarray, rows: np.ndarray | None, limit: int) -> np.ndarray | None:
+        """Rows with the best prefix scores, to be rescored with full vectors"""
+        pool = prefetch_limit(limit)
+        if pool >= (len(self.ids) if rows is None else len(rows)):
+            return rows
+        prefix = self._normalize(query[None, : self.prefix_dim])[0]
+        coarse = (self.prefix if rows is None else self.prefix[rows]) @ prefix
+        # sorted, so the full vectors are read from the memmap in file order
+        keep = np.sort(np.argpartition(-coarse, pool - 1)[:pool])
+        return keep if rows is None else rows[keep]
+
+    def _keyword_rows(self, key: str) -> dict:
+        """Rows by payload value of the key, values of a list are indexed one by one"""
+        if key not in self._postings:
+            postings = {}
+            for row, payload in enumerate(self.payloads):
+                value = payload.get(key)
+                for item in value if isinstance(value, list) else [value]:
+                    if _scalar(item):
+                        postings.setdefault(item, []).append(row)
+            self._postings[key] = {value: np.asarray(rows, dtype=np.int64) for value, rows in postings.items()}
+        return self._postings[key]
+
+    def _number_column(self, key: str) -> np.ndarray:
+        """Numeric payload values of the key, NaN where missing or not a number"""
+        if key not in self._numbers:
+            self._numbers[key] = np.array(
+                [
+                    value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+                    for value in (payload.get(key) for payload in self.payloads)
+                ],
+                dtype=np.float64,
+            )
+        return self._numbers[key]
+
+    def _empty_mask(self, key: str) -> np.ndarray:
+        """Rows where the key is missing, null or an empty list (Qdrant is_empty)"""
+        if key not in self._empty:
+            self._empty[key] = np.array([payload.get(key) in (None, []) for payload in self.payloads], dtype=bool)
+        return self._empty[key]
+
+    def _condition_mask(self, condition) -> np.ndarray:
+        if isinstance(condition, Filter):
+            return self._filter_mask(condition)
+        if isinstance(condition, IsEmptyCondition):
+            return self._empty_mask(condition.is_empty.key)
+
+        mask = np.zeros(len(self.ids), dtype=bool)
+        if isinstance(condition.match, (MatchValue, MatchAny)):
+            postings = self._keyword_rows(condition.key)
+            values = [condition.match.value] if isinstance(condition.match, MatchValue) else condition.match.any
+            for value in values:
+                if value in postings:
+                    mask[postings[value]] = True
+            return mask
+
+        column, bounds = self._number_column(condition.key), condition.range
+        # comparisons with NaN are False, points without the value never match
+        mask = ~np.isnan(column)
+        for bound, compare in (
+            (bounds.gte, np.greater_equal),
+            (bounds.gt, np.greater),
+            (bounds.lte, np.less_equal),
+            (bounds.lt, np.less),
+        ):
+            if bound is not None:
+                mask &= compare(column, bound)
+        return mask
+
+    def _filter_mask(self, query_filter: Filter) -> np.ndarray:
+        """Rows matching the filter, evaluated on payload columns instead of payload by payload"""
+        mask = np.ones(len(self.ids), dtype=bool)
+        for condition in _conditions(query_filter.must):
+            mask &= self._condition_mask(condition)
+        for condition in _conditions(query_filter.must_not):
+            mask &= ~self._condition_mask(condition)
+        if should := _conditions(query_filter.should):
+            mask &= np.logical_or.reduce([self._condition_mask(condition) for condition in should])
+        return mask
+
+    async def search(
+        self,
+        vector: list[float],
+        limit: int = 5,
+        query_filter: Filter | None = None,
+        with_payload: bool = True,
+    ) -> list[ScoredPoint]:
+        if query_filter is not None:
+            check_filter(query_filter)
+        if not self.ids:
+            return []
+
+        query = self._normalize(np.asarray([vector], dtype=np.float32))[0]
+        rows = self._candidates(query)
+        if query_filter is not None:
+            mask = self._filter_mask(query_filter)
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+        if self.prefix is not None:
+            rows = self._prefetch(query, rows, limit)
+
+        scores = self.vectors @ query if rows is None else self.vectors[rows] @ query
+        k = min(limit, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            ScoredPoint(
+                id=self.ids[row],
+                version=0,
+                score=float(scores[i]),
+                payload=self.payloads[row] if with_payload else None,
+            )
+            for i, row in ((i, i if rows is None else int(rows[i])) for i in top)
+        ]
+
+    async def retrieve(self, ids: list) -> list[Record]:
+        return [
+            Record(id=point_id, payload=self.payloads[self.rows[point_id]]) for point_id in ids if point_id in self.rows
+        ]